@@ -0,0 +1,160 @@
+import argparse
+import re
+import time
+
+from mozteststat.gitutils import Repo, iter_tree
+from mozteststat.main import maybe_test_paths
+from mozteststat.testdata import TestData
+from mozteststat.wpt import has_wpt_changes, has_wpt_meta_changes
+
+
+class MochitestMatcher:
+    # The per-suite matchers that were used before PathClassifier, kept here
+    # as the baseline.
+    def __init__(self, paths):
+        self.paths = paths
+
+    def __call__(self, changed_paths):
+        return any(item in self.paths for item in changed_paths)
+
+
+class ReftestMatcher:
+    def __init__(self, dirs, manifest_paths):
+        self.dirs = dirs
+        self.manifest_paths = manifest_paths
+
+    def __call__(self, changed_paths):
+        dirs = self.dirs
+        for path in changed_paths:
+            if path in self.manifest_paths:
+                continue
+            dir_name = path
+            while "/" in dir_name:
+                dir_name = dir_name.rsplit("/", 1)[0]
+                if dir_name in dirs:
+                    return True
+        return False
+
+
+class RegexReftestMatcher:
+    # The original matcher, built as a single alternation over all the test
+    # directories
+    def __init__(self, paths, manifest_paths):
+        parts = []
+        self.manifest_paths = manifest_paths
+        for path in sorted(paths):
+            dir_name = path.rsplit("/", 1)[0]
+            if not (parts and dir_name.startswith(parts[-1])):
+                parts.append(dir_name)
+        self.regex = re.compile("|".join(parts))
+
+    def __call__(self, changed_paths):
+        return any(path not in self.manifest_paths and self.regex.match(path)
+                   for path in changed_paths)
+
+
+def get_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("gecko_root", help="Path to gecko root")
+    parser.add_argument("--rev", default="mozilla/central",
+                        help="Revision to load the test data from")
+    parser.add_argument("--count", type=int, default=100,
+                        help="Number of first-parent diffs to classify")
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="Number of times to classify each diff")
+    parser.add_argument("--regex", action="store_true",
+                        help="Also time the original regex reftest matcher")
+    return parser
+
+
+def get_matchers(test_data, include_regex):
+    matchers = {
+        "web-platform-tests": has_wpt_changes,
+        "web-platform-tests-meta": has_wpt_meta_changes,
+        "mochitest": MochitestMatcher(set(test_data._paths_by_suite["mochitest"])),
+    }
+    regex_matchers = {}
+    for suite in ["reftest", "crashtest"]:
+        manifest_paths = set(test_data._manifest_paths_by_suite[suite])
+        matchers[suite] = ReftestMatcher(set(test_data._test_dirs_by_suite[suite]),
+                                         manifest_paths)
+        if include_regex:
+            regex_matchers[suite] = RegexReftestMatcher(test_data._paths_by_suite[suite],
+                                                        manifest_paths)
+    return matchers, regex_matchers
+
+
+def match_all(matchers, diff_paths):
+    rv = {}
+    for status, paths in diff_paths.items():
+        rv[status] = {suite for suite, matcher in matchers.items() if matcher(paths)}
+    return rv
+
+
+def classify_all(classifier, diff_paths):
+    return {status: classifier.classify(paths) for status, paths in diff_paths.items()}
+
+
+def get_diffs(repo, rev, count, classifier):
+    commit = repo.lookup(rev)
+    diffs = []
+    for _ in range(count):
+        if not commit.commit.parents:
+            break
+        parent = commit.parents[0]
+        diffs.append(maybe_test_paths(commit, parent))
+        commit = parent
+    # Worst case: every path in the tree that isn't in any suite changed, so
+    # nothing can return early
+    diffs.append({"M": [path for path, _ in iter_tree(repo.lookup(rev).tree)
+                        if not classifier.classify([path])]})
+    return diffs
+
+
+def run():
+    parser = get_parser()
+    args = parser.parse_args()
+
+    repo = Repo(args.gecko_root)
+
+    t0 = time.perf_counter()
+    test_data = TestData(repo.lookup(args.rev))
+    print("Loaded test data in %.1fs, %i classifier rules" %
+          (time.perf_counter() - t0, len(test_data.classifier)))
+
+    matchers, regex_matchers = get_matchers(test_data, args.regex)
+    diffs = get_diffs(repo, args.rev, args.count, test_data.classifier)
+    paths = sum(len(paths) for diff_paths in diffs for paths in diff_paths.values())
+    print("Classifying %i diffs, %i changed paths, %i times" % (len(diffs), paths, args.repeat))
+
+    mismatches = 0
+    for diff_paths in diffs:
+        if classify_all(test_data.classifier, diff_paths) != match_all(matchers, diff_paths):
+            mismatches += 1
+    print("%i mismatches" % mismatches)
+
+    engines = [("matchers", lambda diff_paths: match_all(matchers, diff_paths)),
+               ("classifier", lambda diff_paths: classify_all(test_data.classifier,
+                                                              diff_paths))]
+    if regex_matchers:
+        engines.insert(0, ("regex", lambda diff_paths: match_all(regex_matchers, diff_paths)))
+
+    for label, subset in [("first-parent diffs", diffs[:-1]), ("untested paths", diffs[-1:])]:
+        timings = {}
+        for name, engine in engines:
+            t0 = time.perf_counter()
+            for _ in range(args.repeat):
+                for diff_paths in subset:
+                    engine(diff_paths)
+            timings[name] = time.perf_counter() - t0
+        print(label)
+        for name, total in timings.items():
+            print("  %-12s %8.3fs total %8.3fms/diff %6.1fx" % (
+                name,
+                total,
+                1000 * total / max(len(subset) * args.repeat, 1),
+                timings["matchers"] / total if total else 0))
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,118 @@
+import argparse
+import io
+import time
+import tokenize
+from collections import defaultdict
+
+from mozteststat.gitutils import Repo, iter_tree
+from mozteststat.mozbuild import manifest_re, manifest_types, scan_mozbuild
+
+
+def tokenize_mozbuild(data):
+    # The original tokenize based parser, kept here as the baseline.
+    entries = defaultdict(list)
+
+    state = None
+
+    for tok_type, tok_value, _, _, _ in tokenize.tokenize(io.BytesIO(data).readline):
+        if state is None:
+            if tok_type == tokenize.NAME and tok_value in manifest_types:
+                state = (manifest_types[tok_value], "start")
+        else:
+            test_type, substate = state
+            if substate == "start" and tok_type == tokenize.OP:
+                assert tok_value == "+="
+                state = (test_type, "after_op")
+            elif substate == "after_op" and tok_type == tokenize.OP:
+                assert tok_value == "["
+                state = (test_type, "before_entry")
+            elif substate == "before_entry":
+                if tok_type == tokenize.STRING:
+                    entries[test_type].append(tok_value[1:-1])
+                    state = (test_type, "after_entry")
+                elif tok_type == tokenize.OP:
+                    if tok_value == "]":
+                        state = None
+                    else:
+                        assert False
+                else:
+                    assert tok_type == tokenize.NL
+            elif substate == "after_entry":
+                if tok_type == tokenize.OP:
+                    if tok_value == ",":
+                        state = (test_type, "before_entry")
+                    elif tok_value == "]":
+                        state = None
+                    else:
+                        assert False
+                else:
+                    assert tok_type == tokenize.NL
+
+    return dict(entries)
+
+
+def get_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("gecko_root", help="Path to gecko root")
+    parser.add_argument("--rev", default="mozilla/central",
+                        help="Revision to read moz.build files from")
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="Number of times to parse each file")
+    parser.add_argument("--verbose", action="store_true",
+                        help="Print files where the parsers disagree")
+    return parser
+
+
+def run():
+    parser = get_parser()
+    args = parser.parse_args()
+
+    repo = Repo(args.gecko_root)
+    tree = repo.lookup(args.rev).tree
+
+    files = [(path, obj.read_raw()) for path, obj in iter_tree(tree, {"moz.build"})]
+    matching = [(path, data) for path, data in files if manifest_re.search(data)]
+    print("%i moz.build files, %i mention manifests, %i bytes" % (
+        len(files), len(matching), sum(len(data) for _, data in matching)))
+
+    failures = 0
+    mismatches = 0
+    scanner_errors = 0
+    for path, data in matching:
+        entries, errors = scan_mozbuild(data)
+        scanner_errors += len(errors)
+        try:
+            expected = tokenize_mozbuild(data)
+        except (AssertionError, SyntaxError, tokenize.TokenError):
+            failures += 1
+            if args.verbose:
+                print("tokenize failed: %s" % path)
+            continue
+        if entries != expected:
+            mismatches += 1
+            if args.verbose:
+                print("mismatch: %s" % path)
+    print("tokenize failed on %i files, scanner reported %i errors, %i mismatches" % (
+        failures, scanner_errors, mismatches))
+
+    timings = {}
+    for name, func in [("tokenize", tokenize_mozbuild), ("scanner", scan_mozbuild)]:
+        t0 = time.perf_counter()
+        for _ in range(args.repeat):
+            for _, data in matching:
+                try:
+                    func(data)
+                except (AssertionError, SyntaxError, tokenize.TokenError):
+                    pass
+        timings[name] = time.perf_counter() - t0
+
+    for name, total in timings.items():
+        print("%-10s %8.3fs total %8.1fus/file %6.1fx" % (
+            name,
+            total,
+            1e6 * total / max(len(matching) * args.repeat, 1),
+            timings["tokenize"] / total if total else 0))
+
+
+if __name__ == "__main__":
+    run()
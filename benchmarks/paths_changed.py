@@ -0,0 +1,143 @@
+import argparse
+import time
+
+import pygit2
+
+from mozteststat.gitutils import Repo, diff_trees, paths_changed
+from mozteststat.main import non_test_exts
+
+
+def walk_paths_changed(commit, parent):
+    # The original paths_changed tree walk, kept here as the baseline.
+    stack = [(commit.tree, parent.tree, "")]
+
+    diffs = {}
+
+    while stack:
+        commit_tree, parent_tree, path = stack.pop()
+        if (commit_tree is not None and
+            parent_tree is not None and
+            commit_tree.id == parent_tree.id):
+            continue
+
+        if commit_tree is not None:
+            for item in commit_tree:
+                name = item.name
+                item_path = "%s/%s" % (path, name) if path else name
+                if isinstance(item, pygit2.Tree):
+                    stack.append((item,
+                                  parent_tree[name] if (parent_tree is not None and
+                                                        name in parent_tree and
+                                                        isinstance(parent_tree[name],
+                                                                   pygit2.Tree)) else None,
+                                  item_path))
+                else:
+                    if parent_tree is None or name not in parent_tree:
+                        diffs[item_path] = ("A", item)
+                    elif item.id != parent_tree[name].id:
+                        diffs[item_path] = ("M", item)
+
+        if parent_tree is not None:
+            for item in parent_tree:
+                name = item.name
+                if commit_tree is None or name not in commit_tree:
+                    item_path = "%s/%s" % (path, name) if path else name
+                    if isinstance(item, pygit2.Tree):
+                        stack.append((None, item, item_path))
+                    else:
+                        diffs[item_path] = ("D", None)
+
+    return diffs
+
+
+def get_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("gecko_root", help="Path to gecko root")
+    parser.add_argument("--rev", default="mozilla/central",
+                        help="Revision to start the first-parent walk from")
+    parser.add_argument("--count", type=int, default=100,
+                        help="Number of commit pairs to diff")
+    parser.add_argument("--prefix", action="append", dest="prefixes",
+                        help="Restrict the filtered diffs to this directory")
+    return parser
+
+
+def commit_pairs(repo, rev, count):
+    commit = repo.lookup(rev)
+    for _ in range(count):
+        if not commit.commit.parents:
+            break
+        parent = commit.parents[0]
+        yield commit, parent
+        commit = parent
+
+
+def status_map(diffs, skip_exts=None, prefixes=None):
+    rv = {}
+    for path, (status, obj) in diffs.items():
+        if skip_exts is not None and "." in path and path.rsplit(".", 1)[1] in skip_exts:
+            continue
+        if prefixes is not None and not any(path.startswith(prefix + "/")
+                                            for prefix in prefixes):
+            continue
+        rv[path] = status
+    return rv
+
+
+def run():
+    parser = get_parser()
+    args = parser.parse_args()
+
+    repo = Repo(args.gecko_root)
+
+    engines = [
+        ("walk", lambda commit, parent: walk_paths_changed(commit, parent), False),
+        ("paths_changed", lambda commit, parent: paths_changed(commit, parent), False),
+        ("diff_trees", lambda commit, parent: diff_trees(commit, parent), False),
+        ("paths_changed-filtered",
+         lambda commit, parent: paths_changed(commit, parent, prefixes=args.prefixes,
+                                              skip_exts=non_test_exts),
+         True),
+        ("diff_trees-filtered",
+         lambda commit, parent: diff_trees(commit, parent, prefixes=args.prefixes,
+                                           skip_exts=non_test_exts),
+         True),
+    ]
+
+    timings = {name: 0.0 for name, _, _ in engines}
+    pairs = 0
+    paths = 0
+    mismatches = 0
+
+    for commit, parent in commit_pairs(repo, args.rev, args.count):
+        expected = None
+        for name, engine, filtered in engines:
+            t0 = time.perf_counter()
+            diffs = engine(commit, parent)
+            timings[name] += time.perf_counter() - t0
+
+            if expected is None:
+                expected = diffs
+                paths += len(diffs)
+                continue
+
+            if filtered:
+                match = status_map(expected, non_test_exts, args.prefixes) == status_map(diffs)
+            else:
+                match = status_map(expected) == status_map(diffs)
+            if not match:
+                mismatches += 1
+                print("%s mismatch between %s and %s" % (name, commit.sha1, parent.sha1))
+        pairs += 1
+
+    print("Diffed %i commit pairs, %i changed paths, %i mismatches" % (pairs, paths, mismatches))
+    for name, total in timings.items():
+        print("%-24s %8.3fs total %8.2fms/pair %6.1fx" % (
+            name,
+            total,
+            1000 * total / max(pairs, 1),
+            timings["walk"] / total if total else 0))
+
+
+if __name__ == "__main__":
+    run()
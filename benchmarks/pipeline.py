@@ -0,0 +1,158 @@
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+import pygit2
+
+from benchmarks.synthetic import SyntheticRepo
+from mozteststat.cache import clear_caches
+from mozteststat.gitutils import Repo
+from mozteststat.main import get_commits_by_bug, group_commits, maybe_test_paths
+from mozteststat.testdata import TestData
+
+# Version of the output format
+results_version = 1
+
+scales = {
+    "small": {"dirs": 20, "tests_per_dir": 5, "pushes": 30},
+    "medium": {"dirs": 200, "tests_per_dir": 10, "pushes": 100},
+    "large": {"dirs": 1000, "tests_per_dir": 20, "pushes": 300},
+}
+
+
+class StageTimer:
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def time(self, func, *args):
+        t0 = time.perf_counter()
+        rv = func(*args)
+        elapsed = time.perf_counter() - t0
+        self.count += 1
+        self.total += elapsed
+        self.max = max(self.max, elapsed)
+        return rv
+
+    def to_json(self):
+        return {"count": self.count,
+                "total": self.total,
+                "mean_ms": 1000 * self.total / self.count if self.count else 0,
+                "max_ms": 1000 * self.max}
+
+
+def run_scale(name, params, work_dir, seed, lazy=False):
+    stages = {name: StageTimer() for name in ["generate", "get_commits_by_bug",
+                                              "paths_changed", "testdata_init",
+                                              "testdata_update", "classify"]}
+
+    repo_path = os.path.join(work_dir, name)
+    synthetic = SyntheticRepo(repo_path, seed=seed, **params)
+    stages["generate"].time(synthetic.generate)
+
+    cache_dir = os.path.join(work_dir, name + "-cache")
+    os.mkdir(cache_dir)
+    commits_by_bug = stages["get_commits_by_bug"].time(get_commits_by_bug, repo_path,
+                                                       ":memory:", False, cache_dir)
+
+    # Follow the same path through history as a single worker process
+    clear_caches()
+    repo = Repo(repo_path, cinnabar_index_dir=cache_dir)
+    test_data = None
+    changed_paths = 0
+    for commits in commits_by_bug.values():
+        changed = {"A": set(), "M": set()}
+        for commit_range in group_commits([repo.lookup(commit.sha1)
+                                           for commit in commits.commits]):
+            commit_head = commit_range[0]
+            if test_data is None:
+                test_data = stages["testdata_init"].time(TestData, commit_head, lazy)
+            else:
+                changed_paths += stages["testdata_update"].time(test_data.update, commit_head)
+
+            diff_paths = stages["paths_changed"].time(maybe_test_paths, commit_head,
+                                                      commit_range[-1].parents[0],
+                                                      test_data.relevance)
+            if any(value for value in diff_paths.values()):
+                for change_type, suites in stages["classify"].time(test_data.changes,
+                                                                   diff_paths,
+                                                                   changed).items():
+                    changed[change_type] |= suites
+
+    return {"name": name,
+            "params": synthetic.params(),
+            "repo": dict(synthetic.stats(),
+                         relevant_bugs=len(commits_by_bug),
+                         testdata_changed_paths=changed_paths),
+            "stages": {name: timer.to_json() for name, timer in stages.items()}}
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        description="Time each stage of the pipeline against synthetic repositories")
+    parser.add_argument("--scale", action="append", dest="scales", choices=list(scales),
+                        help="Repository sizes to benchmark (default: small and medium)")
+    parser.add_argument("--seed", type=int, default=1, help="Random seed for the repositories")
+    parser.add_argument("--work-dir", help="Directory to generate the repositories in; "
+                        "defaults to a temporary directory that is removed afterwards")
+    parser.add_argument("--lazy", action="store_true",
+                        help="Load moz.build files and test manifests on demand, as with "
+                        "--lazy in the main program")
+    parser.add_argument("--output", help="Path to write the JSON results to")
+    return parser
+
+
+def run():
+    parser = get_parser()
+    args = parser.parse_args()
+
+    selected = args.scales or ["small", "medium"]
+
+    work_dir = args.work_dir
+    if work_dir is None:
+        work_dir = tempfile.mkdtemp(prefix="mozteststat-bench-")
+    else:
+        os.makedirs(work_dir)
+
+    try:
+        results = []
+        for name in selected:
+            result = run_scale(name, scales[name], work_dir, args.seed, args.lazy)
+            results.append(result)
+            print("%s: %i commits, %i files, %i bugs" % (name,
+                                                         result["repo"]["commits"],
+                                                         result["repo"]["files"],
+                                                         result["repo"]["relevant_bugs"]))
+            for stage, timing in result["stages"].items():
+                print("  %-20s %8.3fs total %6i calls %9.2fms mean %9.2fms max" % (
+                    stage, timing["total"], timing["count"], timing["mean_ms"],
+                    timing["max_ms"]))
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(work_dir)
+
+    output = {"version": results_version,
+              "created": time.time(),
+              "environment": {"python": sys.version.split()[0],
+                              "implementation": platform.python_implementation(),
+                              "pygit2": pygit2.__version__,
+                              "libgit2": pygit2.LIBGIT2_VERSION,
+                              "platform": platform.platform(),
+                              "cpus": os.cpu_count()},
+              "seed": args.seed,
+              "lazy": args.lazy,
+              "scales": results}
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(output, f, indent=2)
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,251 @@
+import argparse
+import hashlib
+import json
+import os
+import random
+import shutil
+
+import pygit2
+
+# Commit times start at 2019-06-01 so that all of the generated history is
+# after the default --since date of get_commits_by_bug; the initial commits are
+# earlier so that the history scan has somewhere to stop.
+start_time = 1559347200
+initial_time = 1540000000
+
+
+class TreeWriter:
+    # Nested dict of the files in a tree, which only rewrites the trees on the
+    # path to a changed file when writing a new commit.
+    def __init__(self, repo):
+        self.repo = repo
+        self.root = {}
+        self._tree_ids = {}
+
+    def _dirty(self, parts):
+        for i in range(len(parts) + 1):
+            self._tree_ids.pop(tuple(parts[:i]), None)
+
+    def set(self, path, data):
+        parts = path.split("/")
+        node = self.root
+        for part in parts[:-1]:
+            node = node.setdefault(part, {})
+        node[parts[-1]] = self.repo.create_blob(data)
+        self._dirty(parts[:-1])
+
+    def remove(self, path):
+        parts = path.split("/")
+        nodes = [self.root]
+        for part in parts[:-1]:
+            nodes.append(nodes[-1][part])
+        del nodes[-1][parts[-1]]
+        # Remove directories that are now empty
+        for i in range(len(parts) - 1, 0, -1):
+            if nodes[i]:
+                break
+            del nodes[i - 1][parts[i - 1]]
+        self._dirty(parts[:-1])
+
+    def write(self, node=None, key=()):
+        if node is None:
+            node = self.root
+        tree_id = self._tree_ids.get(key)
+        if tree_id is None:
+            builder = self.repo.TreeBuilder()
+            for name, value in sorted(node.items()):
+                if isinstance(value, dict):
+                    builder.insert(name, self.write(value, key + (name,)),
+                                   pygit2.GIT_FILEMODE_TREE)
+                else:
+                    builder.insert(name, value, pygit2.GIT_FILEMODE_BLOB)
+            tree_id = builder.write()
+            self._tree_ids[key] = tree_id
+        return tree_id
+
+
+class SyntheticRepo:
+    def __init__(self, path, dirs=20, tests_per_dir=5, wpt_dirs=None, pushes=30,
+                 backout_rate=0.15, new_test_rate=0.2, seed=1):
+        self.path = path
+        self.dirs = dirs
+        self.tests_per_dir = tests_per_dir
+        self.wpt_dirs = wpt_dirs if wpt_dirs is not None else dirs
+        self.pushes = pushes
+        self.backout_rate = backout_rate
+        self.new_test_rate = new_test_rate
+        self.random = random.Random(seed)
+
+        self.repo = None
+        self.files = None
+        self.contents = {}
+        self.notes = {}
+        self.commit_count = 0
+        self.bug = 1000
+        self.time = start_time
+
+    def params(self):
+        return {"dirs": self.dirs,
+                "tests_per_dir": self.tests_per_dir,
+                "wpt_dirs": self.wpt_dirs,
+                "pushes": self.pushes,
+                "backout_rate": self.backout_rate,
+                "new_test_rate": self.new_test_rate}
+
+    def set(self, path, data):
+        self.contents[path] = data
+        self.files.set(path, data)
+
+    def initial_files(self):
+        mochitest_ini = b"".join(b"[test_%d.html]\n" % j for j in range(self.tests_per_dir))
+        top_reftests = []
+        for i in range(self.dirs):
+            d = "dom/d%d" % i
+            self.set(d + "/moz.build",
+                     b'# -*- Mode: python -*-\n\nUNIFIED_SOURCES += [\n    "impl.cpp",\n]\n\n'
+                     b'MOCHITEST_MANIFESTS += [\n    "test/mochitest.ini",\n]\n')
+            self.set(d + "/test/mochitest.ini",
+                     b"[DEFAULT]\nsupport-files =\n  support.js\n\n" + mochitest_ini)
+            for j in range(self.tests_per_dir):
+                self.set(d + "/test/test_%d.html" % j, b"test %d" % j)
+            self.set(d + "/test/support.js", b"support")
+            self.set(d + "/impl.cpp", b"int x;")
+
+            r = "layout/r%d" % i
+            top_reftests.append(b"include ../r%d/reftests/reftest.list\n" % i)
+            self.set(r + "/moz.build",
+                     b'if CONFIG["X"]:\n    CRASHTEST_MANIFESTS += [\n'
+                     b'        "crashtests/crashtest.list",\n    ]\n')
+            self.set(r + "/reftests/reftest.list",
+                     b"include sub/reftest.list\n" +
+                     b"".join(b"== a%d.html a%d-ref.html\n" % (j, j)
+                              for j in range(self.tests_per_dir)))
+            self.set(r + "/reftests/sub/reftest.list", b"== b.html b-ref.html\n")
+            for j in range(self.tests_per_dir):
+                self.set(r + "/reftests/a%d.html" % j, b"ref")
+                self.set(r + "/reftests/a%d-ref.html" % j, b"ref")
+            self.set(r + "/reftests/sub/b.html", b"ref")
+            self.set(r + "/reftests/sub/b-ref.html", b"ref")
+            self.set(r + "/crashtests/crashtest.list", b"load c.html\n")
+            self.set(r + "/crashtests/c.html", b"crash")
+            self.set("third_party/rust/c%d/src/lib.rs" % i, b"fn x() {}")
+
+        # A top-level reftest manifest that includes all the others
+        self.set("layout/reftests/moz.build", b'REFTEST_MANIFESTS += ["reftest.list"]\n')
+        self.set("layout/reftests/reftest.list", b"".join(top_reftests))
+
+        for i in range(self.wpt_dirs):
+            for j in range(self.tests_per_dir):
+                self.set("testing/web-platform/tests/t%d/test%d.html" % (i, j), b"wpt")
+            self.set("testing/web-platform/meta/t%d/test0.html.ini" % i, b"meta")
+        self.set("testing/web-platform/tests/tools/x.py", b"tool")
+        self.set("testing/web-platform/tests/resources/testharness.js", b"harness")
+
+    def commit(self, msg, parents):
+        signature = pygit2.Signature("a", "a@example.com", self.time, 0)
+        oid = self.repo.create_commit(None, signature, signature, msg, self.files.write(),
+                                      parents)
+        hg_sha = hashlib.sha1(str(oid).encode("ascii")).hexdigest()
+        self.notes[str(oid)] = hg_sha
+        self.commit_count += 1
+        return oid, hg_sha
+
+    def change_files(self):
+        paths = self.random.sample(self.mutable_paths, self.random.randint(1, 3))
+        for path in paths:
+            self.set(path, self.contents[path] + b"\nchange %d" % self.time)
+        if self.random.random() < self.new_test_rate:
+            i = self.random.randrange(self.dirs)
+            if self.random.random() < 0.5:
+                name = "test_new_%d.html" % self.time
+                self.set("dom/d%d/test/%s" % (i, name), b"new")
+                manifest = "dom/d%d/test/mochitest.ini" % i
+                self.set(manifest, self.contents[manifest] + b"[%s]\n" % name.encode("ascii"))
+            else:
+                name = "new_%d.html" % self.time
+                self.set("layout/r%d/reftests/sub/%s" % (i, name), b"new")
+                manifest = "layout/r%d/reftests/sub/reftest.list" % i
+                self.set(manifest, self.contents[manifest] +
+                         b"== %s b-ref.html\n" % name.encode("ascii"))
+
+    def generate(self):
+        if os.path.exists(self.path):
+            shutil.rmtree(self.path)
+        self.repo = pygit2.init_repository(self.path, bare=True)
+        self.files = TreeWriter(self.repo)
+        self.initial_files()
+        self.mutable_paths = sorted(path for path in self.contents
+                                    if not path.endswith(("moz.build", ".ini", ".list")))
+
+        self.time = initial_time
+        root, _ = self.commit("Initial", [])
+        self.time += 100
+        central, _ = self.commit("Merge autoland to mozilla-central a=merge", [root])
+        side, _ = self.commit("Bug 1 - side", [root])
+        self.time += 100
+        central, _ = self.commit("Merge autoland to mozilla-central a=merge", [central, side])
+
+        self.time = start_time
+        for _ in range(self.pushes):
+            tip = central
+            for _ in range(self.random.randint(1, 4)):
+                self.bug += 1
+                last = None
+                for part in range(self.random.randint(1, 2)):
+                    self.change_files()
+                    self.time += 60
+                    tip, hg_sha = self.commit("Bug %d - change %d r=x" % (self.bug, part),
+                                              [tip])
+                    last = hg_sha
+                if self.random.random() < self.backout_rate:
+                    self.time += 60
+                    tip, _ = self.commit("Backed out changeset %s (bug %d) for failures" %
+                                         (last[:12], self.bug), [tip])
+            self.time += 60
+            central, _ = self.commit("Merge autoland to mozilla-central a=merge", [central, tip])
+            self.time += 3600
+        self.repo.references.create("refs/remotes/mozilla/central", central, force=True)
+
+        notes = TreeWriter(self.repo)
+        for git_sha, hg_sha in self.notes.items():
+            notes.set("%s/%s/%s" % (git_sha[:2], git_sha[2:4], git_sha[4:]),
+                      b"changeset %s\nmanifest %s" %
+                      (hg_sha.encode("ascii"),
+                       hashlib.sha1(hg_sha.encode("ascii")).hexdigest().encode("ascii")))
+        signature = pygit2.Signature("a", "a@example.com", self.time, 0)
+        notes_commit = self.repo.create_commit(None, signature, signature, "notes",
+                                               notes.write(), [])
+        self.repo.references.create("refs/notes/cinnabar", notes_commit, force=True)
+        return self.repo
+
+    def stats(self):
+        return {"commits": self.commit_count,
+                "files": len(self.contents),
+                "bugs": self.bug - 1000}
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description="Generate a synthetic gecko-like repository")
+    parser.add_argument("path", help="Path to write the bare repository to")
+    parser.add_argument("--dirs", type=int, default=20,
+                        help="Number of mochitest and reftest directories")
+    parser.add_argument("--tests-per-dir", type=int, default=5,
+                        help="Number of tests in each directory")
+    parser.add_argument("--wpt-dirs", type=int, default=None,
+                        help="Number of wpt directories (defaults to --dirs)")
+    parser.add_argument("--pushes", type=int, default=30,
+                        help="Number of merges to mozilla-central")
+    parser.add_argument("--seed", type=int, default=1, help="Random seed")
+    return parser
+
+
+def run():
+    args = get_parser().parse_args()
+    synthetic = SyntheticRepo(args.path, dirs=args.dirs, tests_per_dir=args.tests_per_dir,
+                              wpt_dirs=args.wpt_dirs, pushes=args.pushes, seed=args.seed)
+    synthetic.generate()
+    print(json.dumps(dict(synthetic.params(), **synthetic.stats())))
+
+
+if __name__ == "__main__":
+    run()
@@ -1,18 +1,83 @@
 import logging
+from collections import OrderedDict
 
-def path_cache(func):
-    _func_cache = {}
-    def inner(path, obj):
-        if path in _func_cache:
-            cache_obj, cache_result = _func_cache[path]
-            if cache_obj == obj:
-                logging.debug("Getting %s from cache" % path)
-                return cache_result
-        rv = func(path, obj)
-        _func_cache[path] = (obj, rv)
+# Default budget for each cached function, in bytes of parsed source
+default_max_cost = 64 * 1024 * 1024
+
+_caches = []
+
+
+class OidCache:
+    # LRU cache of func(path, obj) keyed on (path, blob id). Only the id is
+    # kept, not the blob. The cost of an entry is the size of the blob it was
+    # parsed from, as a proxy for the size of the result, and entries are
+    # evicted once the total cost exceeds max_cost.
+    def __init__(self, func, max_cost=None):
+        self.func = func
+        self.name = func.__name__
+        self.max_cost = max_cost if max_cost is not None else default_max_cost
+        self.cost = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+
+        self.__name__ = func.__name__
+        self.__doc__ = func.__doc__
+
+    def __call__(self, path, obj):
+        key = (path, obj.id)
+        entry = self._data.get(key)
+        if entry is not None:
+            logging.debug("Getting %s from cache" % path)
+            self.hits += 1
+            self._data.move_to_end(key)
+            return entry[1]
+
+        self.misses += 1
+        rv = self.func(path, obj)
+        cost = max(obj.size, 1)
+        self._data[key] = (cost, rv)
+        self.cost += cost
+        while self.cost > self.max_cost and len(self._data) > 1:
+            _, (evicted_cost, _) = self._data.popitem(last=False)
+            self.cost -= evicted_cost
+            self.evictions += 1
         return rv
 
-    inner.__name__ = func.__name__
-    inner.__doc__ = func.__doc__
+    def clear(self):
+        self._data.clear()
+        self.cost = 0
+
+    def stats(self):
+        return {"entries": len(self._data),
+                "cost": self.cost,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions}
+
+
+def oid_cache(func=None, max_cost=None):
+    # Decorator, usable as @oid_cache or @oid_cache(max_cost=...)
+    def decorator(func):
+        cache = OidCache(func, max_cost)
+        _caches.append(cache)
+        return cache
+
+    if func is not None:
+        return decorator(func)
+    return decorator
+
+
+def cache_stats():
+    return {cache.name: cache.stats() for cache in _caches}
+
+
+def set_max_cost(max_cost):
+    for cache in _caches:
+        cache.max_cost = max_cost
+
 
-    return inner
+def clear_caches():
+    for cache in _caches:
+        cache.clear()
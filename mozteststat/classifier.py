@@ -0,0 +1,177 @@
+class RelevanceIndex:
+    # The directories in which a changed path could match a rule: ancestors
+    # of the paths with exact rules, and everything below a directory rule.
+    # Entries are counted so they can be added and removed incrementally.
+    #
+    # Each node is [children, count, subtree_count], where count is the
+    # number of entries at or below the node and subtree_count the number
+    # that make everything below the node relevant.
+    def __init__(self):
+        self.root = [{}, 0, 0]
+
+    def add(self, dir_path, subtree=False):
+        node = self.root
+        node[1] += 1
+        if dir_path:
+            for component in dir_path.split("/"):
+                children = node[0]
+                child = children.get(component)
+                if child is None:
+                    child = children[component] = [{}, 0, 0]
+                node = child
+                node[1] += 1
+        if subtree:
+            node[2] += 1
+
+    def remove(self, dir_path, subtree=False):
+        nodes = [self.root]
+        components = dir_path.split("/") if dir_path else []
+        for component in components:
+            nodes.append(nodes[-1][0][component])
+        if subtree:
+            nodes[-1][2] -= 1
+        for node in nodes:
+            node[1] -= 1
+        for parent, component in zip(nodes, components):
+            if not parent[0][component][1]:
+                del parent[0][component]
+                break
+
+    def node_for(self, dir_path):
+        # Returns (relevant, node) for a directory. node is None when
+        # everything below the directory is relevant.
+        node = self.root
+        if node[2]:
+            return True, None
+        if dir_path:
+            for component in dir_path.split("/"):
+                node = node[0].get(component)
+                if node is None:
+                    return False, None
+                if node[2]:
+                    return True, None
+        return True, node
+
+    @staticmethod
+    def child(node, name):
+        # Like node_for, for the subdirectory name of a directory node
+        child = node[0].get(name)
+        if child is None:
+            return False, None
+        if child[2]:
+            return True, None
+        return True, child
+
+
+class PathClassifier:
+    # Classifies changed paths against all suites at once.
+    #
+    # Rules are either for exact paths or for directories. A directory rule
+    # applies to every path below that directory. Each rule either includes
+    # the path in a suite or blocks it. For each suite, an exact rule takes
+    # precedence over directory rules, and the rule for the deepest directory
+    # takes precedence over rules for its ancestors.
+    def __init__(self, suites):
+        self.suites = frozenset(suites)
+        # path -> {suite: include}
+        self._exact = {}
+        # Trie of path components. Each node is [children, rules] where
+        # children maps a component to a node and rules is {suite: include}
+        # for the directory at that node, or None
+        self._root = [{}, None]
+        self._dir_count = 0
+        self.relevance = RelevanceIndex()
+
+    def __len__(self):
+        return len(self._exact) + self._dir_count
+
+    def add_path(self, suite, path, include=True):
+        rules = self._exact.get(path)
+        if rules is None:
+            rules = self._exact[path] = {}
+            self.relevance.add(path.rsplit("/", 1)[0] if "/" in path else "")
+        rules[suite] = include
+
+    def remove_path(self, suite, path):
+        rules = self._exact[path]
+        del rules[suite]
+        if not rules:
+            del self._exact[path]
+            self.relevance.remove(path.rsplit("/", 1)[0] if "/" in path else "")
+
+    def add_dir(self, suite, path, include=True):
+        node = self._root
+        for component in path.split("/"):
+            children = node[0]
+            child = children.get(component)
+            if child is None:
+                child = children[component] = [{}, None]
+            node = child
+        if node[1] is None:
+            node[1] = {}
+            self._dir_count += 1
+            self.relevance.add(path, subtree=True)
+        node[1][suite] = include
+
+    def remove_dir(self, suite, path):
+        nodes = [self._root]
+        components = path.split("/")
+        for component in components:
+            nodes.append(nodes[-1][0][component])
+        node = nodes[-1]
+        del node[1][suite]
+        if node[1]:
+            return
+        node[1] = None
+        self._dir_count -= 1
+        self.relevance.remove(path, subtree=True)
+        # Prune nodes that no longer lead to any rules
+        for parent, component in zip(reversed(nodes[:-1]), reversed(components)):
+            child = parent[0][component]
+            if child[0] or child[1] is not None:
+                break
+            del parent[0][component]
+
+    def classify(self, paths, skip=None):
+        # Returns the set of suites, other than those in skip, which have at
+        # least one path included
+        remaining = set(self.suites)
+        if skip:
+            remaining -= skip
+        matched = set()
+        exact = self._exact
+        root = self._root
+
+        for path in paths:
+            if not remaining:
+                break
+
+            # Rules for the path's ancestor directories, shallowest first
+            dir_rules = None
+            components = path.split("/")
+            components.pop()
+            children = root[0]
+            for component in components:
+                node = children.get(component)
+                if node is None:
+                    break
+                if node[1] is not None:
+                    if dir_rules is None:
+                        dir_rules = {}
+                    dir_rules.update(node[1])
+                children = node[0]
+
+            rules = exact.get(path)
+            if rules:
+                if dir_rules is None:
+                    dir_rules = rules
+                else:
+                    dir_rules.update(rules)
+
+            if dir_rules is not None:
+                for suite, include in dir_rules.items():
+                    if include and suite in remaining:
+                        matched.add(suite)
+                        remaining.discard(suite)
+
+        return matched
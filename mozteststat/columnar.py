@@ -0,0 +1,142 @@
+import os
+
+import numpy as np
+
+
+class ResultTable:
+    # Per-bug results stored as columns. Months are stored as
+    # year * 12 + month - 1, and the suites changed for each status as a
+    # bitmask, with bit i set for self.suites[i]
+    version = 1
+
+    def __init__(self, suites, timestamp, bug, month, added, modified):
+        self.suites = list(suites)
+        self.timestamp = timestamp
+        self.bug = bug
+        self.month = month
+        self.added = added
+        self.modified = modified
+
+    def __len__(self):
+        return len(self.bug)
+
+    @classmethod
+    def from_rows(cls, suites, rows):
+        # rows is a list of (timestamp, bug, month, added mask, modified mask)
+        columns = list(zip(*rows)) if rows else [()] * 5
+        return cls(suites,
+                   np.array(columns[0], dtype=np.float64),
+                   np.array(columns[1], dtype=np.int64),
+                   np.array(columns[2], dtype=np.int32),
+                   np.array(columns[3], dtype=np.uint32),
+                   np.array(columns[4], dtype=np.uint32))
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            if int(data["version"]) != cls.version:
+                raise ValueError("Result table %s has version %s, expected %s" %
+                                 (path, int(data["version"]), cls.version))
+            return cls([str(item) for item in data["suites"]],
+                       data["timestamp"],
+                       data["bug"],
+                       data["month"],
+                       data["added"],
+                       data["modified"])
+
+    def save(self, path):
+        tmp_path = path + ".tmp.npz"
+        np.savez(tmp_path,
+                 version=np.array(self.version),
+                 suites=np.array(self.suites),
+                 timestamp=self.timestamp,
+                 bug=self.bug,
+                 month=self.month,
+                 added=self.added,
+                 modified=self.modified)
+        os.replace(tmp_path, path)
+
+    def suite_mask(self, suites):
+        rv = 0
+        for suite in suites:
+            rv |= 1 << self.suites.index(suite)
+        return rv
+
+    def records(self):
+        # Yields (timestamp, bug, {status: [suites]}) in the by_bug.json format
+        suite_bits = [(suite, 1 << i) for i, suite in enumerate(self.suites)]
+        for timestamp, bug, added, modified in zip(self.timestamp.tolist(),
+                                                   self.bug.tolist(),
+                                                   self.added.tolist(),
+                                                   self.modified.tolist()):
+            changed = {}
+            for status, mask in [("A", added), ("M", modified)]:
+                if mask:
+                    changed[status] = sorted(suite for suite, bit in suite_bits if mask & bit)
+            yield (timestamp, bug, changed)
+
+    def by_month(self, headings):
+        # Returns a list of (month, {heading: count}), ordered by month.
+        #
+        # This makes one pass over the rows to count each combination of
+        # (month, added mask, modified mask). Each heading is a condition on
+        # the masks, so the per-month totals are then a single product of that
+        # histogram with a (combination, heading) matrix of conditions
+        if not len(self):
+            return []
+        first_month = int(self.month.min())
+        index = (self.month - first_month).astype(np.intp)
+        num_months = int(index.max()) + 1
+        num_masks = 1 << len(self.suites)
+
+        key = (index * num_masks + self.added.astype(np.intp)) * num_masks + self.modified
+        hist = np.bincount(key, minlength=num_months * num_masks * num_masks)
+        hist = hist.reshape(num_months, num_masks * num_masks)
+
+        added = np.repeat(np.arange(num_masks), num_masks)
+        modified = np.tile(np.arange(num_masks), num_masks)
+        changed = added | modified
+        conditions = {"total": np.ones(num_masks * num_masks, dtype=bool),
+                      "total-added": added != 0,
+                      "total-modified": modified != 0,
+                      "test-total": ((changed != 0) &
+                                     (changed != self.suite_mask(["web-platform-tests-meta"])))}
+        for i, suite in enumerate(self.suites):
+            bit = 1 << i
+            conditions["%s-added" % suite] = (added & bit) != 0
+            conditions["%s-modified" % suite] = (modified & bit) != 0
+            conditions["%s-total" % suite] = (changed & bit) != 0
+
+        counts = hist @ np.stack([conditions[heading] for heading in headings], axis=1)
+
+        rv = []
+        for i in np.flatnonzero(hist.sum(axis=1)).tolist():
+            year, month = divmod(first_month + i, 12)
+            rv.append(("%04i-%02i" % (year, month + 1),
+                       dict(zip(headings, counts[i].tolist()))))
+        return rv
+
+
+def month_index(date):
+    return date.year * 12 + date.month - 1
+
+
+def row_record(suites, row):
+    # The (timestamp, bug, {status: [suites]}) record for a result row
+    timestamp, bug_number, _, added, modified = row
+    changed = {}
+    for status, mask in [("A", added), ("M", modified)]:
+        if mask:
+            changed[status] = sorted(suite for i, suite in enumerate(suites)
+                                     if mask & (1 << i))
+    return (timestamp, bug_number, changed)
+
+
+def result_row(suites, date, bug_number, changed):
+    masks = []
+    for status in ["A", "M"]:
+        mask = 0
+        for suite in changed.get(status, ()):
+            mask |= 1 << suites.index(suite)
+        masks.append(mask)
+    return (date.timestamp(), bug_number, month_index(date), masks[0], masks[1])
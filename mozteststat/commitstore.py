@@ -0,0 +1,133 @@
+import logging
+import sqlite3
+from collections import namedtuple
+
+CommitInfo = namedtuple("CommitInfo", ["sha1",
+                                       "parents",
+                                       "commit_time",
+                                       "hg_sha",
+                                       "bug_numbers",
+                                       "backouts",
+                                       "is_merge",
+                                       "is_wpt_sync"])
+
+
+def commit_info(commit):
+    backouts, _ = commit.commits_backed_out()
+    return CommitInfo(commit.sha1,
+                      tuple(str(parent_id) for parent_id in commit.commit.parent_ids),
+                      commit.commit.commit_time,
+                      commit.hg_sha,
+                      tuple(commit.bug_numbers),
+                      tuple(backouts),
+                      commit.is_merge,
+                      bool(commit.is_wpt_sync))
+
+
+class CommitStore:
+    # Bump this when the stored fields, or the way they are derived, change
+    version = 1
+
+    def __init__(self, path, readonly=False):
+        self.path = path
+        self._pending = []
+        if readonly:
+            self._conn = sqlite3.connect("file:%s?mode=ro" % path, uri=True)
+        else:
+            self._conn = sqlite3.connect(path)
+            self._create()
+
+    def _create(self):
+        if self.path != ":memory:":
+            # Allow readers in other processes while this connection writes
+            self._conn.execute("PRAGMA journal_mode=WAL")
+        with self._conn:
+            self._conn.execute("CREATE TABLE IF NOT EXISTS meta "
+                               "(key TEXT PRIMARY KEY, value TEXT)")
+            version = self.get_meta("version")
+            if version is not None and int(version) != self.version:
+                logging.info("Commit store has version %s, expected %s; clearing" %
+                             (version, self.version))
+                self._conn.execute("DROP TABLE IF EXISTS commits")
+                self._conn.execute("DELETE FROM meta")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS commits "
+                               "(sha1 TEXT PRIMARY KEY, "
+                               "parents TEXT, "
+                               "commit_time INTEGER, "
+                               "hg_sha TEXT, "
+                               "bug_numbers TEXT, "
+                               "backouts TEXT, "
+                               "is_merge INTEGER, "
+                               "is_wpt_sync INTEGER)")
+            self.set_meta("version", str(self.version))
+
+    def clear(self):
+        self._pending = []
+        with self._conn:
+            self._conn.execute("DELETE FROM commits")
+            self._conn.execute("DELETE FROM meta")
+            self.set_meta("version", str(self.version))
+
+    def get_meta(self, key):
+        row = self._conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row is not None else None
+
+    def set_meta(self, key, value):
+        with self._conn:
+            self._conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                               (key, value))
+
+    def has(self, sha1):
+        return self._conn.execute("SELECT 1 FROM commits WHERE sha1 = ?",
+                                  (sha1,)).fetchone() is not None
+
+    def get(self, sha1):
+        row = self._conn.execute("SELECT sha1, parents, commit_time, hg_sha, bug_numbers, "
+                                 "backouts, is_merge, is_wpt_sync FROM commits "
+                                 "WHERE sha1 = ?", (sha1,)).fetchone()
+        if row is None:
+            return None
+        return self._info(row)
+
+    def get_all(self):
+        # {sha1: CommitInfo} for every stored commit, read in a single query
+        self.flush()
+        return {row[0]: self._info(row)
+                for row in self._conn.execute("SELECT sha1, parents, commit_time, hg_sha, "
+                                              "bug_numbers, backouts, is_merge, is_wpt_sync "
+                                              "FROM commits")}
+
+    def _info(self, row):
+        sha1, parents, commit_time, hg_sha, bug_numbers, backouts, is_merge, is_wpt_sync = row
+        return CommitInfo(sha1,
+                          tuple(parents.split()),
+                          commit_time,
+                          hg_sha,
+                          tuple(int(item) for item in bug_numbers.split()),
+                          tuple(backouts.split()),
+                          bool(is_merge),
+                          bool(is_wpt_sync))
+
+    def add(self, info):
+        self._pending.append((info.sha1,
+                              " ".join(info.parents),
+                              info.commit_time,
+                              info.hg_sha,
+                              " ".join(str(item) for item in info.bug_numbers),
+                              " ".join(info.backouts),
+                              int(info.is_merge),
+                              int(info.is_wpt_sync)))
+        if len(self._pending) >= 1000:
+            self.flush()
+
+    def flush(self):
+        with self._conn:
+            if self._pending:
+                self._conn.executemany("INSERT OR REPLACE INTO commits VALUES "
+                                       "(?, ?, ?, ?, ?, ?, ?, ?)",
+                                       self._pending)
+                self._pending = []
+
+    def close(self):
+        self.flush()
+        self._conn.close()
@@ -1,11 +1,18 @@
+import logging
+import mmap
+import os
 import re
+import struct
 import subprocess
+from collections import OrderedDict
 
 import pygit2
 from mozautomation import commitparser
 
 wpt_sync_re = re.compile(rb".*(?:\[wpt PR \d+\]|Update web-platform-tests to [0-9a-fA-F]{40})")
 
+sha1_re = re.compile("^[0-9a-f]{40}$")
+
 def iter_tree(tree, names=None):
     stack = [(tree, [])]
     while stack:
@@ -23,57 +30,282 @@ def iter_tree(tree, names=None):
                     yield str_path, item
 
 
-def paths_changed(commit, parent):
-    stack = [(commit.tree, parent.tree, "")]
+def get_subtree(tree, path):
+    if not path:
+        return tree
+    try:
+        obj = tree[path]
+    except KeyError:
+        return None
+    return obj if isinstance(obj, pygit2.Tree) else None
+
+
+def has_ext(path, exts):
+    return "." in path and path.rsplit(".", 1)[1] in exts
+
+
+def paths_changed(commit, parent, prefixes=None, skip_exts=None, relevant=None):
+    # Returns {path: (status, obj)} with status in "A", "M", "D" and obj the blob
+    # in commit (None for deletions). prefixes restricts the comparison to the
+    # given directories, and paths with an extension in skip_exts are dropped.
+    # relevant is a RelevanceIndex; subtrees that it doesn't contain are
+    # skipped without reading their entries.
+    stack = []
+    for prefix in (prefixes or [""]):
+        node = None
+        if relevant is not None:
+            is_relevant, node = relevant.node_for(prefix)
+            if not is_relevant:
+                continue
+        stack.append((get_subtree(commit.tree, prefix), get_subtree(parent.tree, prefix),
+                      prefix, node))
 
     diffs = {}
 
+    def push(commit_tree, parent_tree, path, node, name):
+        if node is None:
+            stack.append((commit_tree, parent_tree, path, None))
+        else:
+            is_relevant, child = relevant.child(node, name)
+            if is_relevant:
+                stack.append((commit_tree, parent_tree, path, child))
+
     while stack:
-        commit_tree, parent_tree, path = stack.pop()
+        commit_tree, parent_tree, path, node = stack.pop()
         if (commit_tree is not None and
             parent_tree is not None and
             commit_tree.id == parent_tree.id):
             continue
 
+        path_prefix = path + "/" if path else ""
+        parent_items = {item.name: item for item in parent_tree} if parent_tree is not None else {}
+
         if commit_tree is not None:
             for item in commit_tree:
                 name = item.name
-                item_path = "%s/%s" % (path, name) if path else name
+                parent_item = parent_items.pop(name, None)
+                parent_is_tree = isinstance(parent_item, pygit2.Tree)
                 if isinstance(item, pygit2.Tree):
-                    stack.append((item,
-                                  parent_tree[name] if (parent_tree is not None and
-                                                        name in parent_tree and
-                                                        isinstance(parent_tree[name],
-                                                                   pygit2.Tree)) else None,
-                                  item_path))
-                else:
-                    if parent_tree is None or name not in parent_tree:
-                        diffs[item_path] = ("A", item)
-                    elif item.id != parent_tree[name].id:
-                        diffs[item_path] = ("M", item)
+                    push(item, parent_item if parent_is_tree else None, path_prefix + name,
+                         node, name)
+                    if parent_item is not None and not parent_is_tree:
+                        parent_items[name] = parent_item
+                    continue
+                if parent_is_tree:
+                    push(None, parent_item, path_prefix + name, node, name)
+                if skip_exts is not None and has_ext(name, skip_exts):
+                    continue
+                if parent_item is None or parent_is_tree:
+                    diffs[path_prefix + name] = ("A", item)
+                elif item.id != parent_item.id:
+                    diffs[path_prefix + name] = ("M", item)
 
-        if parent_tree is not None:
-            for item in parent_tree:
-                name = item.name
-                if commit_tree is None or name not in commit_tree:
-                    item_path = "%s/%s" % (path, name) if path else name
-                    if isinstance(item, pygit2.Tree):
-                        stack.append((None, item, item_path))
-                    else:
-                        diffs[item_path] = ("D", None)
+        for name, item in parent_items.items():
+            if isinstance(item, pygit2.Tree):
+                push(None, item, path_prefix + name, node, name)
+            elif skip_exts is None or not has_ext(name, skip_exts):
+                diffs[path_prefix + name] = ("D", None)
 
     return diffs
 
 
+def diff_trees(commit, parent, prefixes=None, skip_exts=None):
+    # Same contract as paths_changed, but the comparison is done by libgit2.
+    # libgit2 expands every entry of both trees rather than skipping identical
+    # subtrees, so this only wins when a large part of the tree differs.
+    repo = commit.repo.repo
+    diffs = {}
+
+    for prefix in (prefixes or [""]):
+        path_prefix = prefix + "/" if prefix else ""
+        commit_tree = get_subtree(commit.tree, prefix)
+        parent_tree = get_subtree(parent.tree, prefix)
+
+        if commit_tree is None and parent_tree is None:
+            continue
+
+        if (commit_tree is not None and
+            parent_tree is not None and
+            commit_tree.id == parent_tree.id):
+            continue
+
+        flags = pygit2.GIT_DIFF_SKIP_BINARY_CHECK | pygit2.GIT_DIFF_INCLUDE_TYPECHANGE
+        if parent_tree is None:
+            diff = commit_tree.diff_to_tree(flags=flags, context_lines=0, swap=True)
+        elif commit_tree is None:
+            diff = parent_tree.diff_to_tree(flags=flags, context_lines=0)
+        else:
+            diff = parent_tree.diff_to_tree(commit_tree, flags=flags, context_lines=0)
+
+        for delta in diff.deltas:
+            status = delta.status_char()
+            if status == "D":
+                path = delta.old_file.path
+            else:
+                path = delta.new_file.path
+            if skip_exts is not None and has_ext(path, skip_exts):
+                continue
+            if status == "D":
+                diffs[path_prefix + path] = ("D", None)
+            else:
+                # Typechanges (e.g. file to symlink) are reported as modifications
+                diffs[path_prefix + path] = ("A" if status == "A" else "M",
+                                             repo[delta.new_file.id])
+
+    return diffs
+
+
+def read_cinnabar_changeset(data):
+    for line in data.split(b"\n"):
+        if line.startswith(b"changeset "):
+            return line[len(b"changeset "):]
+    return None
+
+
+class CinnabarIndex:
+    # Mapping from git sha to hg changeset sha, stored as a header followed by
+    # two arrays of 20 byte shas, the git shas in sorted order and the hg
+    # shas in the corresponding order.
+    magic = b"MTSCINN1"
+    header = struct.Struct("<8sQ")
+
+    def __init__(self, data):
+        try:
+            magic, count = self.header.unpack_from(data, 0)
+        except struct.error:
+            raise ValueError("Cinnabar index is truncated")
+        if magic != self.magic:
+            raise ValueError("Not a cinnabar index")
+        if len(data) != self.header.size + 40 * count:
+            raise ValueError("Cinnabar index is %i bytes, expected %i for %i entries" %
+                             (len(data), self.header.size + 40 * count, count))
+        self._data = data
+        self._count = count
+        self._git_offset = self.header.size
+        self._hg_offset = self._git_offset + 20 * count
+
+    def __len__(self):
+        return self._count
+
+    def get(self, sha1):
+        key = bytes.fromhex(sha1)
+        data = self._data
+        offset = self._git_offset
+        lo = 0
+        hi = self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if data[offset + 20 * mid:offset + 20 * (mid + 1)] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self._count and data[offset + 20 * lo:offset + 20 * (lo + 1)] == key:
+            hg_offset = self._hg_offset + 20 * lo
+            return data[hg_offset:hg_offset + 20].hex()
+        return None
+
+    def items(self):
+        for i in range(self._count):
+            git_offset = self._git_offset + 20 * i
+            hg_offset = self._hg_offset + 20 * i
+            yield (self._data[git_offset:git_offset + 20],
+                   self._data[hg_offset:hg_offset + 20])
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "rb") as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return cls(data)
+
+    @classmethod
+    def write(cls, path, mapping):
+        git_shas = sorted(mapping)
+        tmp_path = "%s.%i.tmp" % (path, os.getpid())
+        with open(tmp_path, "wb") as f:
+            f.write(cls.header.pack(cls.magic, len(git_shas)))
+            f.write(b"".join(git_shas))
+            f.write(b"".join(mapping[git_sha] for git_sha in git_shas))
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def read_notes(notes_commit, prev_notes_commit=None, prev_index=None):
+        # Read the git sha -> hg sha mapping from the notes tree. With a previous
+        # index only the notes that changed since that index was built are read.
+        if prev_index is not None:
+            mapping = dict(prev_index.items())
+            changes = paths_changed(notes_commit, prev_notes_commit)
+        else:
+            mapping = {}
+            changes = {path: ("A", obj) for path, obj in iter_tree(notes_commit.tree)}
+
+        # When the notes fanout changes the same sha is both deleted and added
+        # under different paths, so apply all the deletions first
+        updates = []
+        for path, (status, obj) in changes.items():
+            try:
+                git_sha = bytes.fromhex(path.replace("/", ""))
+            except ValueError:
+                git_sha = None
+            if git_sha is None or len(git_sha) != 20:
+                logging.debug("Skipping cinnabar note %s" % path)
+                continue
+            if status == "D":
+                mapping.pop(git_sha, None)
+            else:
+                updates.append((git_sha, obj))
+
+        for git_sha, obj in updates:
+            hg_sha = read_cinnabar_changeset(obj.read_raw())
+            if hg_sha is None:
+                continue
+            try:
+                mapping[git_sha] = bytes.fromhex(hg_sha.decode("ascii"))
+            except ValueError:
+                logging.debug("Skipping cinnabar note for %s" % git_sha.hex())
+        return mapping
+
+
 class Repo():
-    def __init__(self, path):
-        self._commit_cache = {}
+    def __init__(self, path, cinnabar_index_dir=None, commit_cache_size=10000):
+        self._commit_cache = OrderedDict()
+        self.commit_cache_size = commit_cache_size
+        self.commit_cache_hits = 0
+        self.commit_cache_misses = 0
+        self.commit_cache_evictions = 0
         self.repo = pygit2.Repository(path)
         self._cinnabar_notes = None
+        self.cinnabar_index = None
+        if cinnabar_index_dir is not None:
+            self.load_cinnabar_index(cinnabar_index_dir)
 
     def lookup(self, rev):
+        if sha1_re.match(rev):
+            return self.get(pygit2.Oid(hex=rev))
         pygit2_commit = self.repo.revparse_single(rev)
-        return Commit(self, pygit2_commit)
+        return self.get(pygit2_commit.id, pygit2_commit)
+
+    def get(self, oid, pygit2_commit=None):
+        commit = self._commit_cache.get(oid)
+        if commit is not None:
+            self.commit_cache_hits += 1
+            self._commit_cache.move_to_end(oid)
+            return commit
+
+        self.commit_cache_misses += 1
+        if pygit2_commit is None:
+            pygit2_commit = self.repo[oid]
+        commit = Commit(self, pygit2_commit)
+        self._commit_cache[oid] = commit
+        if len(self._commit_cache) > self.commit_cache_size:
+            self._commit_cache.popitem(last=False)
+            self.commit_cache_evictions += 1
+        return commit
+
+    def commit_cache_stats(self):
+        return {"size": len(self._commit_cache),
+                "hits": self.commit_cache_hits,
+                "misses": self.commit_cache_misses,
+                "evictions": self.commit_cache_evictions}
 
     @property
     def cinnabar_notes(self):
@@ -81,6 +313,45 @@ class Repo():
             self._cinnabar_notes = self.repo.revparse_single("refs/notes/cinnabar")
         return self._cinnabar_notes
 
+    def load_cinnabar_index(self, cache_dir):
+        # Read the whole of refs/notes/cinnabar into a CinnabarIndex file named
+        # after the notes commit, so that hg shas can be looked up without
+        # touching the object database. An index for an earlier notes commit
+        # is updated rather than rebuilt from scratch, and a corrupt index is
+        # rebuilt.
+        notes = self.cinnabar_notes
+        path = os.path.join(cache_dir, "cinnabar-%s.idx" % notes.id)
+        if os.path.exists(path):
+            try:
+                self.cinnabar_index = CinnabarIndex.load(path)
+                return self.cinnabar_index
+            except ValueError as e:
+                logging.warning("Rebuilding cinnabar index %s: %s" % (path, e))
+                os.unlink(path)
+
+        prev_paths = [os.path.join(cache_dir, name) for name in os.listdir(cache_dir)
+                      if name.startswith("cinnabar-") and name.endswith(".idx")]
+        prev_notes = None
+        prev_index = None
+        for prev_path in prev_paths:
+            prev_id = os.path.basename(prev_path)[len("cinnabar-"):-len(".idx")]
+            try:
+                prev_notes = self.repo[prev_id]
+                prev_index = CinnabarIndex.load(prev_path)
+            except (KeyError, ValueError):
+                continue
+            break
+
+        logging.info("Building cinnabar index for notes %s%s" %
+                     (notes.id, " from %s" % prev_notes.id if prev_index else ""))
+        CinnabarIndex.write(path, CinnabarIndex.read_notes(notes, prev_notes, prev_index))
+
+        for prev_path in prev_paths:
+            os.unlink(prev_path)
+
+        self.cinnabar_index = CinnabarIndex.load(path)
+        return self.cinnabar_index
+
     @property
     def workdir(self):
         return self.repo.workdir
@@ -91,26 +362,34 @@ class Repo():
 
 
 class Commit():
-    def __new__(cls, repo, commit):
-        if commit.id not in repo._commit_cache:
-            repo._commit_cache[commit.id] = super().__new__(cls)
-        return repo._commit_cache[commit.id]
+    __slots__ = ("repo", "commit", "_cinnabar_data", "_bug_numbers", "_backouts",
+                 "_is_wpt_sync")
 
     def __init__(self, repo, commit):
         self.repo = repo
         self.commit = commit
 
-        self.is_backed_out = False
-        self.test_hash = None
-
         self._cinnabar_data = None
 
+        # Values derived from the commit message, filled in on first use
+        self._bug_numbers = None
+        self._backouts = None
+        self._is_wpt_sync = None
+
+    def __eq__(self, other):
+        return isinstance(other, Commit) and self.commit.id == other.commit.id
+
+    def __hash__(self):
+        return hash(self.commit.id)
+
     @property
     def sha1(self):
         return str(self.commit.id)
 
     @property
     def hg_sha(self):
+        if self.repo.cinnabar_index is not None:
+            return self.repo.cinnabar_index.get(self.sha1)
         return self.cinnabar_data.get("changeset")
 
     @property
@@ -125,11 +404,13 @@ class Commit():
 
     @property
     def parents(self):
-        return [self.repo.lookup(str(parent.id)) for parent in self.commit.parents]
+        return [self.repo.get(parent_id) for parent_id in self.commit.parent_ids]
 
     @property
     def is_wpt_sync(self):
-        return wpt_sync_re.match(self.msg)
+        if self._is_wpt_sync is None:
+            self._is_wpt_sync = wpt_sync_re.match(self.msg) is not None
+        return self._is_wpt_sync
 
     @property
     def tree(self):
@@ -163,6 +444,12 @@ class Commit():
         return self._cinnabar_data
 
     def commits_backed_out(self):
+        if self._backouts is None:
+            self._backouts = self._read_backouts()
+        commits, bugs = self._backouts
+        return list(commits), set(bugs)
+
+    def _read_backouts(self):
         commits = []
         bugs = []
         if self.is_backout:
@@ -171,19 +458,21 @@ class Commit():
                 # We think this a backout, but have no idea what it backs out
                 # it's not clear how to handle that case so for now we pretend it isn't
                 # a backout
-                return commits, set(bugs)
+                return tuple(commits), frozenset(bugs)
 
             nodes, bugs = nodes_bugs
             # Assuming that all commits are listed.
             for node in nodes:
                 commits.append(node.decode("ascii"))
 
-        return commits, set(bugs)
+        return tuple(commits), frozenset(bugs)
 
     @property
     def is_merge(self):
-        return len(self.commit.parents) > 1
+        return len(self.commit.parent_ids) > 1
 
     @property
     def bug_numbers(self):
-        return commitparser.parse_bugs(self.msg)
+        if self._bug_numbers is None:
+            self._bug_numbers = commitparser.parse_bugs(self.msg)
+        return self._bug_numbers
@@ -0,0 +1,77 @@
+import logging
+import multiprocessing
+
+import pygit2
+
+from .commitstore import CommitStore, commit_info
+from .gitutils import Repo
+
+
+def get_segments(head, min_time, num_segments, boundary=None):
+    # Split the first-parent chain from head back to the first commit older
+    # than min_time, or to boundary, into runs of consecutive commits. Each
+    # segment is (head sha1, hide sha1), covering the commits reachable from
+    # head but not from hide, so the segments are disjoint.
+    chain = []
+    commit = head
+    while True:
+        if commit.sha1 == boundary:
+            hide = boundary
+            break
+        # This includes the first commit older than min_time, which is where
+        # the serial scan stops
+        chain.append(commit.sha1)
+        if commit.commit.commit_time < min_time or not commit.commit.parent_ids:
+            hide = str(commit.commit.parent_ids[0]) if commit.commit.parent_ids else None
+            break
+        commit = commit.repo.get(commit.commit.parent_ids[0])
+
+    segment_size = max(1, -(-len(chain) // num_segments))
+    rv = []
+    for start in range(0, len(chain), segment_size):
+        end = start + segment_size
+        rv.append((chain[start], chain[end] if end < len(chain) else hide))
+    return rv
+
+
+def scan_segment(task):
+    repo_path, cache_dir, store_path, head, hide = task
+    repo = Repo(repo_path, cinnabar_index_dir=cache_dir, commit_cache_size=0)
+    store = CommitStore(store_path, readonly=True) if store_path != ":memory:" else None
+
+    rv = []
+    walker = repo.repo.walk(pygit2.Oid(hex=head), pygit2.GIT_SORT_NONE)
+    if hide is not None:
+        walker.hide(pygit2.Oid(hex=hide))
+    for git_commit in walker:
+        if store is not None and store.has(str(git_commit.id)):
+            continue
+        rv.append(commit_info(repo.get(git_commit.id, git_commit)))
+
+    if store is not None:
+        store.close()
+    return rv
+
+
+def scan_history(repo_path, store, head, min_time, num_processes, cache_dir=None,
+                 boundary=None):
+    # Read the commit metadata needed by get_commits_by_bug into the store
+    # using several processes. This covers the commits that the serial scan
+    # will visit, so that it can then run entirely from the store. The
+    # commits reachable from boundary, the tip of an earlier scan, are
+    # assumed to be stored already.
+    segments = get_segments(head, min_time, num_processes * 4, boundary)
+    logging.info("Scanning history in %i segments with %i processes" %
+                 (len(segments), num_processes))
+    tasks = [(repo_path, cache_dir, store.path, segment_head, hide)
+             for segment_head, hide in segments]
+
+    count = 0
+    with multiprocessing.Pool(num_processes) as pool:
+        for records in pool.imap(scan_segment, tasks):
+            for info in records:
+                store.add(info)
+            count += len(records)
+    store.flush()
+    logging.info("Scanned %i new commits" % count)
+    return count
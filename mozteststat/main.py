@@ -2,6 +2,7 @@
 
 import argparse
 import csv
+import gc
 import json
 import logging
 import math
@@ -10,22 +11,95 @@ import os
 import time
 import traceback
 from collections import OrderedDict, defaultdict, deque
-from datetime import datetime
-from queue import Empty
+from datetime import datetime, timedelta
+from multiprocessing.connection import wait
 
+import pygit2
+
+from .cache import cache_stats, set_max_cost
+from .columnar import ResultTable, result_row, row_record
+from .commitstore import CommitStore, commit_info
 from .gitutils import Repo, paths_changed
+from .historyscan import scan_history
+from .metrics import MetricsRecorder, WorkerMetrics, default_interval
+from .parsecache import ParseCache, format_stats, get_cache, set_cache
+from .profiling import Profiler, clear_profiles, merge_profiles, stage
+from .resultbatch import ResultBatcher
+from .resultlog import ResultLog
+from .scheduler import Scheduler
+from .snapshot import SnapshotStore, write_snapshots
 from .testdata import TestData
 
 
 suites = ["crashtest", "reftest", "mochitest", "web-platform-tests", "web-platform-tests-meta"]
 
+non_test_exts = {"h", "cpp", "rs"}
+
+# Defaults for --ref and --since
+default_ref = "mozilla/central"
+default_since = datetime(2019, 1, 1)
+
+# Backouts that haven't matched a commit after we walked this far back are
+# assumed to refer to something outside the scanned history
+backout_expiry = timedelta(days=365)
+
+
+def parse_date(value):
+    try:
+        return datetime.strptime(value, "%Y-%m-%d")
+    except ValueError:
+        raise argparse.ArgumentTypeError("Expected a date as YYYY-MM-DD, got %r" % value)
+
+
+def epoch_seconds(date):
+    return (date - datetime(1970, 1, 1)).total_seconds()
+
 
 def get_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument("gecko_root", help="Path to gecko root")
     parser.add_argument("--rebuild", action="store_true", help="Don't use existing data")
+    parser.add_argument("--ref", default=default_ref,
+                        help="Ref or commit to scan history from (default: %(default)s)")
+    parser.add_argument("--since", type=parse_date, default=default_since,
+                        help="Stop scanning history at merges older than this date, as "
+                        "YYYY-MM-DD (default: %s)" % default_since.strftime("%Y-%m-%d"))
+    parser.add_argument("--until", type=parse_date,
+                        help="Start scanning history at the last first-parent commit of "
+                        "--ref before this date, as YYYY-MM-DD")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Only scan commits that are newer than the tip processed by the "
+                        "last complete run, and merge their results into the existing ones; "
+                        "an interrupted incremental run is resumed. Falls back to a full scan "
+                        "if that run used a different --since")
     parser.add_argument("--processes", action="store", type=int, default=4,
                         help="Number of processes to use")
+    parser.add_argument("--scan-processes", action="store", type=int, default=1,
+                        help="Number of processes to use for reading commit metadata")
+    parser.add_argument("--snapshot-interval", action="store", type=int, default=0,
+                        help="Write TestData snapshots every N first-parent commits and start "
+                        "workers from the nearest one (0 to disable)")
+    parser.add_argument("--cache-size", action="store", type=int, default=64,
+                        help="Memory budget in MB for each in-process parse cache, "
+                        "measured in bytes of parsed source")
+    parser.add_argument("--profile", action="store_true",
+                        help="Profile the main process and each worker, writing .prof files, "
+                        "merged.prof and a summary with the time spent in each stage to "
+                        "<out_path>/profile")
+    parser.add_argument("--metrics-interval", action="store", type=int, default=default_interval,
+                        help="Seconds between snapshots of runtime metrics written to "
+                        "<out_path>/metrics.jsonl; a summary is written to "
+                        "<out_path>/metrics_summary.json at the end of the run")
+    parser.add_argument("--warm-start", action="store_true",
+                        help="Build TestData once in the main process and fork the workers "
+                        "from it, rather than each worker building its own")
+    parser.add_argument("--lazy", action="store_true",
+                        help="Only read the moz.build files in a top-level directory, and "
+                        "the test manifests they list, once a change below them needs to be "
+                        "classified. Faster to start, but references into another top-level "
+                        "directory are missed until that one is read")
+    parser.add_argument("--report-only", action="store_true",
+                        help="Only regenerate by_bug.json and by_month.csv from by_bug.npz")
     parser.add_argument("out_path", type=os.path.abspath, help="Path to write output")
     return parser
 
@@ -62,76 +136,211 @@ class BugCommits():
         self.shas.add(commit.sha1)
 
 
-def is_relevant_commit(commit):
-    return (not (commit.is_backed_out or
+class BackoutIndex:
+    def __init__(self):
+        # Backed out hg shas are usually abbreviated, so index them by length;
+        # matching a full sha is then one set lookup per distinct length.
+        self._by_length = defaultdict(set)
+        # hg sha -> commit time of the backout, in the order they were added
+        self._added = {}
+
+    def __len__(self):
+        return len(self._added)
+
+    def add(self, hg_sha, commit_time):
+        if hg_sha not in self._added:
+            self._by_length[len(hg_sha)].add(hg_sha)
+            self._added[hg_sha] = commit_time
+
+    def remove(self, hg_sha):
+        del self._added[hg_sha]
+        shas = self._by_length[len(hg_sha)]
+        shas.remove(hg_sha)
+        if not shas:
+            del self._by_length[len(hg_sha)]
+
+    def pop_match(self, hg_sha):
+        for length in sorted(self._by_length):
+            prefix = hg_sha[:length]
+            if prefix in self._by_length[length]:
+                self.remove(prefix)
+                return prefix
+        return None
+
+    def expire(self, cutoff):
+        # Remove the oldest-added entries while their backout commit time is
+        # after cutoff, stopping at the first entry that is at or before it.
+        # Entries are in the order they were added, which is roughly newest
+        # backout first, so an entry after cutoff that was added later than
+        # one before it is only removed by a later call.
+        stale = []
+        for hg_sha, commit_time in self._added.items():
+            if commit_time <= cutoff:
+                break
+            stale.append(hg_sha)
+        for hg_sha in stale:
+            self.remove(hg_sha)
+        return stale
+
+
+def is_relevant_commit(commit, is_backed_out):
+    return (not (is_backed_out or
                  commit.is_merge or
                  commit.is_wpt_sync) and
             commit.bug_numbers)
 
 
-def get_commits_by_bug(gecko_root):
+def resolve_head(repo, ref=default_ref, until=None):
+    # The commit to scan history from; with until, the last commit on the
+    # first-parent chain of ref that is older than until
+    head = repo.lookup(ref)
+    if until is not None:
+        max_time = epoch_seconds(until)
+        while head.commit.commit_time >= max_time:
+            if not head.commit.parent_ids:
+                raise ValueError("No commit on %s is older than %s" % (ref, until))
+            head = repo.get(head.commit.parent_ids[0])
+    return head
+
+
+def new_commits_since(repo, head, previous_tip):
+    # The sha1s of the commits reachable from head but not from previous_tip,
+    # or None if previous_tip isn't an ancestor of head
+    previous_oid = pygit2.Oid(hex=previous_tip)
+    if previous_oid not in repo.repo:
+        return None
+    if previous_oid == head.commit.id or repo.repo.descendant_of(previous_oid, head.commit.id):
+        return set()
+    if not repo.repo.descendant_of(head.commit.id, previous_oid):
+        return None
+    walker = repo.repo.walk(head.commit.id, pygit2.GIT_SORT_NONE)
+    walker.hide(previous_oid)
+    return {str(git_commit.id) for git_commit in walker}
+
+
+def get_commits_by_bug(gecko_root, store_path=":memory:", rebuild=False, cache_dir=None,
+                       scan_processes=1, ref=default_ref, since=default_since, until=None,
+                       previous_tip=None):
+    # With previous_tip, only the commits that aren't reachable from it are
+    # scanned
     logging.info("Reading commits")
-    repo = Repo(gecko_root)
+    repo = Repo(gecko_root, cinnabar_index_dir=cache_dir)
+    store = CommitStore(store_path)
+    if rebuild:
+        store.clear()
 
-    backed_out = set()
+    backed_out = BackoutIndex()
     commits_by_bug = OrderedDict()
     seen = set()
+    new_commits = 0
 
     last_trustworthy_date = None
-    min_date = datetime(2019, 1, 1)
 
-    queue = deque([repo.lookup("mozilla/central")])
-    while True:
-        commit = queue.popleft()
-
-        if commit.sha1 in seen:
+    head = resolve_head(repo, ref, until)
+    stored_tip = store.get_meta("tip")
+    logging.info("Scanning history from %s, previous scan started at %s" %
+                 (head.sha1, stored_tip))
+
+    # The commits reachable from stored_tip were stored by the scan from it,
+    # back to its since date
+    boundary = None
+    tip_since = store.get_meta("tip_since")
+    if tip_since is not None and tip_since <= since.strftime("%Y-%m-%d"):
+        boundary = stored_tip
+
+    include = None
+    if previous_tip is not None:
+        include = new_commits_since(repo, head, previous_tip)
+        if include is None:
+            logging.warning("Previous tip %s isn't an ancestor of %s, scanning all history" %
+                            (previous_tip, head.sha1))
+        else:
+            logging.info("Scanning %i commits since previous tip %s" %
+                         (len(include), previous_tip))
+
+    if scan_processes > 1 and include is None:
+        new_commits += scan_history(gecko_root,
+                                    store,
+                                    head,
+                                    epoch_seconds(since),
+                                    scan_processes,
+                                    cache_dir=cache_dir,
+                                    boundary=boundary)
+
+    # Everything the walk needs is normally stored already, apart from the
+    # commits since stored_tip
+    known = store.get_all()
+
+    queue = deque([head.sha1] if include is None or include else [])
+    while queue:
+        sha1 = queue.popleft()
+
+        if sha1 in seen:
             continue
-
-        logging.debug("Commit %s - %s", commit.sha1, commit.msg.split(b"\n", 1)[0].decode("utf-8"))
-        seen.add(commit.sha1)
-
-        if backed_out:
-            hg_sha = commit.hg_sha
-
-            if hg_sha:
-                found = None
-                for sha in backed_out:
-                    if hg_sha.startswith(sha):
-                        found = sha
-                        break
-                if found is not None:
-                    logging.debug("Commit was backed out")
-                    backed_out.remove(sha)
-                    commit.is_backed_out = True
-
-        hg_backout_shas, _ = commit.commits_backed_out()
-        if hg_backout_shas:
-            logging.debug("Commit backs out %s" % ",".join(hg_backout_shas))
-        backed_out |= set(hg_backout_shas)
-
-        if not hg_backout_shas and is_relevant_commit(commit):
-            logging.debug("Adding commit")
+        seen.add(sha1)
+
+        commit = known.get(sha1)
+        if commit is None:
+            git_commit = repo.lookup(sha1)
+            logging.debug("Commit %s - %s", sha1,
+                          git_commit.msg.split(b"\n", 1)[0].decode("utf-8"))
+            commit = commit_info(git_commit)
+            store.add(commit)
+            new_commits += 1
+
+        is_backed_out = False
+        if backed_out and commit.hg_sha and backed_out.pop_match(commit.hg_sha) is not None:
+            logging.debug("Commit %s was backed out" % sha1)
+            is_backed_out = True
+
+        if commit.backouts:
+            logging.debug("Commit %s backs out %s" % (sha1, ",".join(commit.backouts)))
+        for hg_sha in commit.backouts:
+            backed_out.add(hg_sha, commit.commit_time)
+
+        if not commit.backouts and is_relevant_commit(commit, is_backed_out):
+            logging.debug("Adding commit %s" % sha1)
             bug_number = commit.bug_numbers[0]
             if bug_number not in commits_by_bug:
                 commits_by_bug[bug_number] = BugCommits(last_trustworthy_date)
 
             commits_by_bug[bug_number].append(commit)
 
-        elif commit.is_merge or hg_backout_shas:
-            date = datetime.utcfromtimestamp(commit.commit.commit_time)
+        elif commit.is_merge or commit.backouts:
+            date = datetime.utcfromtimestamp(commit.commit_time)
             logging.debug("Using commit date %s" % date)
             if last_trustworthy_date is None:
                 for item in commits_by_bug.values():
                     if item.date is None:
                         item.date = date
             last_trustworthy_date = date
-            if last_trustworthy_date < min_date:
+            if last_trustworthy_date < since:
                 break
 
+            stale = backed_out.expire(commit.commit_time + backout_expiry.total_seconds())
+            if stale:
+                logging.debug("Expiring unmatched backouts %s" % ",".join(stale))
+
         for parent in commit.parents:
-            if parent.sha1 not in seen:
+            if parent not in seen and (include is None or parent in include):
                 queue.append(parent)
 
+    if last_trustworthy_date is None:
+        # No merge or backout was scanned, e.g. when there are only a few
+        # commits after previous_tip
+        date = datetime.utcfromtimestamp(head.commit.commit_time)
+        for item in commits_by_bug.values():
+            item.date = date
+
+    if backed_out:
+        logging.info("%i backed out commits were not found" % len(backed_out))
+
+    store.flush()
+    store.set_meta("tip", head.sha1)
+    store.set_meta("tip_since", since.strftime("%Y-%m-%d"))
+    store.close()
+    logging.info("Read %i commits, %i new" % (len(seen), new_commits))
+
     return commits_by_bug
 
 
@@ -147,38 +356,122 @@ def group_commits(commits):
         yield group
 
 
-def maybe_test_paths(diff_paths):
-    skip_exts = {"h", "cpp", "rs"}
+def maybe_test_paths(commit, parent, relevant=None):
     rv = {
         "A": set(),
         "M": set(),
         "D": set()
     }
-    for path, (status, obj) in diff_paths.items():
-        if "." not in path or path.rsplit(".", 1)[1] not in skip_exts:
-            rv[status].add(path)
+    for path, (status, obj) in paths_changed(commit, parent, skip_exts=non_test_exts,
+                                             relevant=relevant).items():
+        rv[status].add(path)
     return rv
 
 
-def get_suites_changes(repo_path, by_bug_queue, result_queue, progress=None):
-    test_data = None
+class UpdateStats:
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def add(self, size):
+        self.count += 1
+        self.total += size
+        self.max = max(self.max, size)
+
+    def __str__(self):
+        return "%i updates, mean %.1f changed paths, max %i" % (
+            self.count,
+            self.total / self.count if self.count else 0,
+            self.max)
+
+
+def open_parse_cache(cache_dir):
+    set_cache(ParseCache(os.path.join(cache_dir, "parse_cache.sqlite")))
+
+
+def close_parse_cache():
+    cache = get_cache()
+    if cache is None:
+        return
+    cache.close()
+    set_cache(None)
+    if cache.stats:
+        logging.info("Parse cache %s" % format_stats(cache.stats))
+
+
+def get_suites_changes(repo_path, by_bug_queue, send, progress=None, cache_dir=None,
+                       snapshot_dir=None, cache_budget=None, profile_dir=None, metrics=None,
+                       metrics_interval=default_interval, test_data=None, lazy=False):
+    # test_data is a TestData inherited from the main process when the
+    # worker was forked after warming up.
+    #
+    # send(message) delivers a message to the ResultHandler in the main
+    # process. Results are sent as lists of result rows, followed by None when
+    # the worker is done. Metrics snapshots go to the MetricsRecorder when
+    # running in the main process, and are sent as a dict otherwise
+    profiler = None
+    if profile_dir is not None:
+        profiler = Profiler(profile_dir, "worker-%i" % os.getpid())
+        profiler.start()
+
     commit_head = None
     commit_parent = None
-
-    repo = Repo(repo_path)
+    update_stats = UpdateStats()
+    results = ResultBatcher(send)
+    worker_metrics = WorkerMetrics(multiprocessing.current_process().name, metrics_interval)
+
+    repo = Repo(repo_path, cinnabar_index_dir=cache_dir)
+    if test_data is not None:
+        test_data.rebind(repo)
+    snapshots = SnapshotStore(snapshot_dir) if snapshot_dir is not None else None
+    if cache_dir is not None:
+        open_parse_cache(cache_dir)
+    if cache_budget is not None:
+        set_max_cost(cache_budget)
 
     if progress is not None:
         progress.start()
 
+    def report_metrics():
+        snapshot = worker_metrics.snapshot(repo)
+        if metrics is not None:
+            metrics.update_worker(snapshot)
+        else:
+            results.send(snapshot)
+
     try:
         while True:
+            # Getting more work can block on the other workers
+            results.maybe_flush()
             maybe_data = by_bug_queue.get()
             if maybe_data is None:
                 logging.info("Process finished; no more bugs")
-                result_queue.put(None)
+                logging.info("Processed %i bugs in %i batches, stole work %i times" %
+                             (by_bug_queue.count, by_bug_queue.batches, by_bug_queue.steals))
+                logging.info("TestData: %s" % update_stats)
+                logging.info("Commit cache hits: %(hits)i misses: %(misses)i "
+                             "evictions: %(evictions)i" % repo.commit_cache_stats())
+                for name, stats in sorted(cache_stats().items()):
+                    logging.info("%s cache: %i entries, %i bytes, hits: %i misses: %i "
+                                 "evictions: %i" % (name,
+                                                    stats["entries"],
+                                                    stats["cost"],
+                                                    stats["hits"],
+                                                    stats["misses"],
+                                                    stats["evictions"]))
+                report_metrics()
+                close_parse_cache()
+                if profiler is not None:
+                    # Before signalling completion, since the parent only
+                    # waits briefly for workers to exit
+                    profiler.stop()
+                    profiler = None
+                results.send(None)
                 return
 
             bug, date, commit_shas = maybe_data
+            results.maybe_flush()
 
             logging.debug("Processing bug %s" % bug)
             commits = [repo.lookup(sha) for sha in commit_shas]
@@ -187,95 +480,243 @@ def get_suites_changes(repo_path, by_bug_queue, result_queue, progress=None):
             for commit_range in group_commits(commits):
                 logging.debug("Using commits %s" % " ".join(item.sha1 for item in commits))
                 commit_head = commit_range[0]
-                if test_data is None:
-                    test_data = TestData(commit_head)
-                else:
-                    test_data.update(commit_head)
+                with stage("testdata update"):
+                    if test_data is None and snapshots is not None:
+                        test_data = snapshots.load_nearest(repo, commit_head, lazy)
+                    if test_data is None:
+                        test_data = TestData(commit_head, lazy=lazy)
+                    else:
+                        t0 = time.perf_counter()
+                        update_stats.add(test_data.update(commit_head))
+                        worker_metrics.update_latency.add(time.perf_counter() - t0)
 
                 commit_parent = commit_range[-1].parents[0]
 
-                diff_paths = maybe_test_paths(paths_changed(commit_head, commit_parent))
+                with stage("tree diff"):
+                    diff_paths = maybe_test_paths(commit_head, commit_parent,
+                                                  test_data.relevance)
+                worker_metrics.diff_sizes.add(sum(len(paths) for paths in diff_paths.values()))
                 if any(value for value in diff_paths.values()):
-                    for change_type, suites in test_data.changes(diff_paths,
-                                                                 changed).items():
-                        changed[change_type] |= suites
+                    with stage("classification"):
+                        test_changes = test_data.changes(diff_paths, changed)
+                    for change_type, changed_suites in test_changes.items():
+                        changed[change_type] |= changed_suites
                 else:
                     logging.debug("No possible test changes")
 
-            result_queue.put((date, bug, changed))
+            results.put(result_row(suites, date, bug, changed))
 
             if progress is not None:
                 progress.done()
+            if metrics is not None:
+                metrics.result()
+            worker_metrics.bug_done()
+            if worker_metrics.due():
+                report_metrics()
     except Exception:
         logging.critical("Subprocess had an exception:\n%s", traceback.format_exc())
         raise
-
-
-def get_test_changes(repo_path, commits_by_bug, seen_bugs, by_bug_file, by_month_file,
-                     num_processes=4):
-    by_bug_queue = multiprocessing.Queue()
-    result_queue = multiprocessing.Queue()
-
+    finally:
+        if profiler is not None:
+            profiler.stop()
+
+
+def build_shared_test_data(repo_path, items, cache_dir=None, snapshot_dir=None,
+                           cache_budget=None, lazy=False):
+    # Build a TestData at the middle of the work items for the workers to be
+    # forked from, so the moz.build and manifest state and the parse caches
+    # are shared copy-on-write instead of being built by each worker. Returns
+    # None if workers can't be forked.
+    if "fork" not in multiprocessing.get_all_start_methods():
+        logging.warning("Can't fork workers on this platform; each worker will build its "
+                        "own TestData")
+        return None
+    if not items:
+        return None
+
+    repo = Repo(repo_path, cinnabar_index_dir=cache_dir)
+    commit = repo.lookup(items[len(items) // 2][2][0])
+    logging.info("Building TestData for workers at %s" % commit.sha1)
+    if cache_budget is not None:
+        set_max_cost(cache_budget)
+    if cache_dir is not None:
+        open_parse_cache(cache_dir)
+    try:
+        test_data = None
+        if snapshot_dir is not None:
+            test_data = SnapshotStore(snapshot_dir).load_nearest(repo, commit, lazy)
+            if test_data is not None:
+                test_data.update(commit)
+        if test_data is None:
+            test_data = TestData(commit, lazy=lazy)
+    finally:
+        # Workers open their own connections
+        close_parse_cache()
+    return test_data
+
+
+def get_test_changes(repo_path, commits_by_bug, seen_bugs, result_log, by_bug_table_file,
+                     by_bug_file, by_month_file, num_processes=4, cache_dir=None,
+                     snapshot_dir=None, cache_budget=None, profile_dir=None, metrics=None,
+                     warm_start=False, lazy=False, previous=None):
+    # Returns True if every bug that was queued got a result.
+    #
+    # previous is {bug: record} for the results written by the last run, for
+    # an incremental run where commits_by_bug only has the commits since
+    # then. Bugs in commits_by_bug are processed again and the new result is
+    # merged into the previous one, and the previous results for all the
+    # other bugs are kept. In that case seen_bugs only has the results that
+    # an interrupted run over the same commits already merged.
+    #
+    # by_bug_table_file is only written once every bug has a result, since
+    # it's the input to the next incremental run.
     progress = ProgressMeter(len(commits_by_bug))
 
+    rows = []
+
+    # commits_by_bug is in history order, so the scheduler gives each worker
+    # a contiguous stretch of history to move its TestData along
+    items = []
     for bug_number, commits in commits_by_bug.items():
         if bug_number in seen_bugs:
             timestamp, bug_number, changed = seen_bugs[bug_number]
-            date = datetime.utcfromtimestamp(timestamp)
-            result_queue.put((date, bug_number, changed))
+            with stage("result handling"):
+                add_result(datetime.utcfromtimestamp(timestamp), bug_number, changed, rows)
         else:
             progress.queue_bug()
-            by_bug_queue.put((bug_number,
-                              commits.date,
-                              [commit.sha1 for commit in commits.commits]))
+            items.append((bug_number,
+                          commits.date,
+                          [commit.sha1 for commit in commits.commits]))
+
+    if previous is not None:
+        kept = 0
+        with stage("result handling"):
+            for bug_number, (timestamp, _, changed) in previous.items():
+                if bug_number not in commits_by_bug:
+                    add_result(datetime.utcfromtimestamp(timestamp), bug_number, changed, rows)
+                    kept += 1
+        logging.info("Keeping %i results from the previous run" % kept)
+    cached_rows = len(rows)
+
+    scheduler = Scheduler(items, max(num_processes, 1))
+
+    if metrics is not None:
+        metrics.queued = progress.queued_bugs
+
+        def queue_depths():
+            return {"worker-%i" % worker_id: remaining
+                    for worker_id, remaining in enumerate(scheduler.remaining())}
+        metrics.set_queue_depths(queue_depths)
 
     processes = None
+    connections = None
     if num_processes > 1:
-        processes = [multiprocessing.Process(target=get_suites_changes,
-                                             args=(repo_path, by_bug_queue, result_queue))
-                     for i in range(num_processes)]
-        for proc in processes:
-            by_bug_queue.put(None)
+        context = multiprocessing
+        test_data = None
+        if warm_start:
+            with stage("warm start"):
+                test_data = build_shared_test_data(repo_path, items, cache_dir=cache_dir,
+                                                   snapshot_dir=snapshot_dir,
+                                                   cache_budget=cache_budget, lazy=lazy)
+            if test_data is not None:
+                context = multiprocessing.get_context("fork")
+
+        worker_kwargs = {"test_data": test_data,
+                         "cache_dir": cache_dir,
+                         "snapshot_dir": snapshot_dir,
+                         "cache_budget": cache_budget,
+                         "profile_dir": profile_dir,
+                         "lazy": lazy,
+                         "metrics_interval": (metrics.interval if metrics is not None
+                                              else default_interval)}
+        processes = []
+        connections = []
+        if test_data is not None:
+            # Keep the collector from touching, and so copying, the inherited
+            # objects in the workers
+            gc.freeze()
+        for i in range(num_processes):
+            reader, writer = context.Pipe(duplex=False)
+            proc = context.Process(target=get_suites_changes,
+                                   args=(repo_path, scheduler.queue(i), writer.send),
+                                   kwargs=worker_kwargs)
             proc.start()
-    else:
-        get_suites_changes(repo_path, by_bug_queue, result_queue, progress=progress)
-        progress = None
-
-    headings, by_month = get_by_month()
-    all_data = []
+            # Only the worker writes to the pipe
+            writer.close()
+            processes.append(proc)
+            connections.append(reader)
+        if test_data is not None:
+            del worker_kwargs["test_data"], test_data
+            gc.unfreeze()
 
     try:
-        handle_results(processes, result_queue, progress, all_data, by_month)
+        if processes is not None:
+            progress.start()
+            handle_results(processes, connections,
+                           ResultHandler(result_log, rows, progress, metrics, previous), metrics)
+        else:
+            get_suites_changes(repo_path, scheduler.queue(0),
+                               ResultHandler(result_log, rows, previous=previous).handle,
+                               progress=progress, cache_dir=cache_dir,
+                               snapshot_dir=snapshot_dir, cache_budget=cache_budget,
+                               metrics=metrics, lazy=lazy)
     finally:
         if processes is not None:
             for proc in processes:
                 proc.join(2)
                 if proc.is_alive():
                     proc.terminate()
-            by_bug_queue.close()
-            result_queue.close()
+            for reader in connections:
+                reader.close()
+
+        result_log.close()
+
+        complete = len(rows) - cached_rows == len(items)
+        if previous is not None and not complete:
+            # Report the previous results for the bugs that didn't get a
+            # new one
+            processed = {row[1] for row in rows[cached_rows:]}
+            with stage("result handling"):
+                for bug_number, _, _ in items:
+                    if bug_number not in processed and bug_number in previous:
+                        timestamp, _, changed = previous[bug_number]
+                        add_result(datetime.utcfromtimestamp(timestamp), bug_number,
+                                   changed, rows)
 
-        with open(by_bug_file, "w") as f:
-            json.dump(all_data, f)
+        with stage("reports"):
+            table = ResultTable.from_rows(suites, rows)
+            if complete:
+                table.save(by_bug_table_file)
+            write_reports(table, by_bug_file, by_month_file)
 
-        with open(by_month_file, "w") as f:
-            field_names = ["month"] + headings
-            writer = csv.DictWriter(f, field_names)
-            writer.writeheader()
-            for month, data in by_month.items():
-                data["month"] = month
-                writer.writerow(data)
+        if metrics is not None:
+            metrics.close()
 
+    return complete
 
-def get_by_month():
+
+def get_headings():
     headings = []
     for status in ["added", "modified", "total"]:
         for suite in suites:
             headings.append("%s-%s" % (suite, status))
 
     headings.extend(["total-added", "total-modified", "test-total", "total"])
-    by_month = defaultdict(lambda: {heading: 0 for heading in headings})
-    return headings, by_month
+    return headings
+
+
+def write_reports(table, by_bug_file, by_month_file):
+    with open(by_bug_file, "w") as f:
+        json.dump(list(table.records()), f)
+
+    headings = get_headings()
+    with open(by_month_file, "w") as f:
+        field_names = ["month"] + headings
+        writer = csv.DictWriter(f, field_names)
+        writer.writeheader()
+        for month, data in table.by_month(headings):
+            data["month"] = month
+            writer.writerow(data)
 
 
 class ProgressMeter:
@@ -301,7 +742,7 @@ class ProgressMeter:
     def done(self):
         assert self.t0 is not None
         self.processed_count += 1
-        fraction_done = (self.processed_count - self.cache_count) / self.queued_bugs
+        fraction_done = self.processed_count / self.queued_bugs
         int_percent_done = math.floor(100 * fraction_done)
         if int_percent_done > self.last_percent_done:
             time_passed = time.time() - self.t0
@@ -311,54 +752,97 @@ class ProgressMeter:
             self.last_percent_done = int_percent_done
 
 
-def handle_results(processes, result_queue, progress, all_data, by_month):
-    num_processes = len(processes) if processes is not None else 1
-    finished_proc_count = 0
-
-    status_names = {"A": "added", "M": "modified"}
-
-    if progress is not None:
-        progress.start()
-
-    while True:
+def add_result(date, bug_number, changed, rows):
+    # Returns the record for the result log
+    json_safe_changed = {}
+    for status, suites_changed in changed.items():
+        if suites_changed:
+            json_safe_changed[status] = list(sorted(suites_changed))
+
+    rows.append(result_row(suites, date, bug_number, json_safe_changed))
+    return (date.timestamp(), bug_number, json_safe_changed)
+
+
+def merge_result(row, record):
+    # Combines a result row for the newer commits of a bug with the record of
+    # an earlier result for the same bug. As in a full scan, the date is that
+    # of the newest commits.
+    timestamp, bug_number, month, added, modified = row
+    _, _, _, old_added, old_modified = result_row(suites,
+                                                  datetime.utcfromtimestamp(record[0]),
+                                                  bug_number, record[2])
+    return (timestamp, bug_number, month, added | old_added, modified | old_modified)
+
+
+class ResultHandler:
+    # Handles the messages sent by get_suites_changes. Results for bugs in
+    # previous, a {bug: record} dict, are merged with those records.
+    def __init__(self, result_log, rows, progress=None, metrics=None, previous=None):
+        self.result_log = result_log
+        self.rows = rows
+        self.progress = progress
+        self.metrics = metrics
+        self.previous = previous
+
+    def handle(self, message):
+        # Returns False once the worker has finished
+        if message is None:
+            return False
+
+        if isinstance(message, dict):
+            if self.metrics is not None:
+                self.metrics.update_worker(message)
+            return True
+
+        with stage("result handling"):
+            for row in message:
+                if self.previous and row[1] in self.previous:
+                    row = merge_result(row, self.previous[row[1]])
+                self.rows.append(row)
+                self.result_log.append(row_record(suites, row))
+
+        for _ in message:
+            if self.progress is not None:
+                self.progress.done()
+            if self.metrics is not None:
+                self.metrics.result()
+        return True
+
+
+def handle_results(processes, connections, handler, metrics=None):
+    # Waits for messages from any worker, or for a worker to exit. The
+    # timeout is only there to write metrics while no results are arriving.
+    active = dict(zip(connections, processes))
+    sentinels = {proc.sentinel: reader for reader, proc in active.items()}
+    timeout = max(metrics.interval, 1) if metrics is not None else None
+
+    def receive(reader):
         try:
-            maybe_data = result_queue.get(True, timeout=10)
-        except Empty:
-            if num_processes > 1 and not any(process.is_alive() for process in processes):
-                break
-
-        if maybe_data is None:
-            finished_proc_count += 1
-            if finished_proc_count == num_processes:
-                break
-            continue
-
-        date, bug_number, changed = maybe_data
-
-        month_str = date.strftime("%Y-%m")
-        by_month[month_str]["total"] += 1
-
-        json_safe_changed = {}
-        all_suites_changed = set()
-        for status, suites_changed in changed.items():
-            status_name = status_names[status]
-            if suites_changed:
-                json_safe_changed[status] = list(sorted(suites_changed))
-                by_month[month_str]["total-%s" % status_name] += 1
-                for suite in suites_changed:
-                    by_month[month_str]["%s-%s" % (suite, status_name)] += 1
-                    all_suites_changed.add(suite)
-
-        for suite in all_suites_changed:
-            by_month[month_str]["%s-total" % (suite,)] += 1
-
-        if all_suites_changed and all_suites_changed != {"web-platform-tests-meta"}:
-            by_month[month_str]["test-total"] += 1
-
-        all_data.append((date.timestamp(), bug_number, json_safe_changed))
-
-        if progress is not None:
-            progress.done()
+            message = reader.recv()
+        except EOFError:
+            worker_exited(reader)
+            return
+        if not handler.handle(message):
+            del active[reader]
+
+    def worker_exited(reader):
+        proc = active.pop(reader)
+        proc.join()
+        logging.error("%s exited with code %s before finishing" % (proc.name, proc.exitcode))
+
+    while active:
+        for ready in wait(list(active) + list(sentinels), timeout):
+            if ready in sentinels:
+                # Read anything the worker sent before it exited
+                reader = sentinels.pop(ready)
+                while reader in active and reader.poll():
+                    receive(reader)
+                if reader in active:
+                    worker_exited(reader)
+            elif ready in active:
+                receive(ready)
+        if metrics is not None:
+            metrics.maybe_write()
 
 
 def run():
@@ -366,25 +850,150 @@ def run():
     args = parser.parse_args()
 
     by_bug_file = os.path.join(args.out_path, "by_bug.json")
+    by_bug_table_file = os.path.join(args.out_path, "by_bug.npz")
     by_month_file = os.path.join(args.out_path, "by_month.csv")
 
-    seen_bugs = {}
-    if not args.rebuild and os.path.exists(by_bug_file):
-        with open(by_bug_file) as f:
-            try:
-                for item in json.load(f):
-                    seen_bugs[item[1]] = tuple(item)
-            except ValueError:
-                logging.warn("Loading cached data failed, rebuilding")
-
-    commits_by_bug = get_commits_by_bug(args.gecko_root)
-
-    get_test_changes(args.gecko_root,
-                     commits_by_bug,
-                     seen_bugs,
-                     by_bug_file,
-                     by_month_file,
-                     args.processes)
+    if args.report_only:
+        write_reports(ResultTable.load(by_bug_table_file), by_bug_file, by_month_file)
+        return
+
+    profile_dir = None
+    profiler = None
+    if args.profile:
+        profile_dir = os.path.join(args.out_path, "profile")
+        clear_profiles(profile_dir)
+        profiler = Profiler(profile_dir, "main")
+        profiler.start()
+
+    try:
+        result_log = ResultLog(os.path.join(args.out_path, "by_bug.jsonl"))
+
+        seen_bugs = {}
+        logged = []
+        if args.rebuild:
+            result_log.open(truncate=True)
+        else:
+            for item in result_log.records():
+                seen_bugs[item[1]] = tuple(item)
+                logged.append(item)
+            result_log.open()
+            if not seen_bugs and os.path.exists(by_bug_file):
+                # Import results from before there was a log
+                with open(by_bug_file) as f:
+                    try:
+                        for item in json.load(f):
+                            seen_bugs[item[1]] = tuple(item)
+                            logged.append(item)
+                            result_log.append(item)
+                    except ValueError:
+                        logging.warn("Loading cached data failed, rebuilding")
+                result_log.sync()
+            logging.info("Read %i results from %s" % (len(seen_bugs), result_log.path))
+
+        store_path = os.path.join(args.out_path, "commits.sqlite")
+        repo = Repo(args.gecko_root)
+        head = resolve_head(repo, args.ref, args.until)
+
+        # The results in by_bug_table_file cover the history from
+        # processed_tip back to processed_since
+        since = args.since.strftime("%Y-%m-%d")
+        previous_tip = None
+        previous = None
+        if args.incremental and not args.rebuild:
+            store = CommitStore(store_path)
+            previous_tip = store.get_meta("processed_tip")
+            previous_since = store.get_meta("processed_since")
+            if previous_tip is None or not os.path.exists(by_bug_table_file):
+                logging.info("No previous complete run, scanning all history")
+                previous_tip = None
+            elif previous_since != since:
+                logging.info("Previous run used --since %s rather than %s, scanning all "
+                             "history" % (previous_since, since))
+                previous_tip = None
+            elif pygit2.Oid(hex=previous_tip) not in repo.repo:
+                logging.warning("Previous tip %s is no longer in the repository, scanning all "
+                                "history" % previous_tip)
+                previous_tip = None
+            elif repo.repo.descendant_of(pygit2.Oid(hex=previous_tip), head.commit.id):
+                store.close()
+                parser.error("%s is older than the tip processed by the last run, %s; "
+                             "run without --incremental to scan up to it" %
+                             (head.sha1, previous_tip))
+            else:
+                previous = {record[1]: record
+                            for record in ResultTable.load(by_bug_table_file).records()}
+
+                # The results logged since an interrupted run over the same
+                # commits started are already merged with previous, so that
+                # run is resumed; earlier results in the log are stale
+                run_key = "%s %s" % (previous_tip, head.sha1)
+                pending = store.get_meta("incremental_run")
+                start = len(logged)
+                if pending is not None and pending.rsplit(" ", 1)[0] == run_key:
+                    start = int(pending.rsplit(" ", 1)[1])
+                else:
+                    store.set_meta("incremental_run", "%s %i" % (run_key, start))
+                seen_bugs = {item[1]: tuple(item) for item in logged[start:]}
+                if seen_bugs:
+                    logging.info("Resuming with %i results from an interrupted run" %
+                                 len(seen_bugs))
+            store.close()
+
+        with stage("history scan"):
+            commits_by_bug = get_commits_by_bug(args.gecko_root,
+                                                store_path,
+                                                args.rebuild,
+                                                cache_dir=args.out_path,
+                                                scan_processes=args.scan_processes,
+                                                ref=head.sha1,
+                                                since=args.since,
+                                                previous_tip=previous_tip)
+
+        snapshot_dir = None
+        if args.snapshot_interval > 0:
+            snapshot_dir = os.path.join(args.out_path, "snapshots")
+            set_max_cost(args.cache_size * 1024 * 1024)
+            open_parse_cache(args.out_path)
+            with stage("snapshots"):
+                write_snapshots(repo,
+                                SnapshotStore(snapshot_dir),
+                                head,
+                                epoch_seconds(args.since),
+                                args.snapshot_interval)
+            close_parse_cache()
+
+        complete = get_test_changes(args.gecko_root,
+                                    commits_by_bug,
+                                    seen_bugs,
+                                    result_log,
+                                    by_bug_table_file,
+                                    by_bug_file,
+                                    by_month_file,
+                                    args.processes,
+                                    cache_dir=args.out_path,
+                                    snapshot_dir=snapshot_dir,
+                                    cache_budget=args.cache_size * 1024 * 1024,
+                                    profile_dir=profile_dir,
+                                    metrics=MetricsRecorder(
+                                        os.path.join(args.out_path, "metrics.jsonl"),
+                                        os.path.join(args.out_path, "metrics_summary.json"),
+                                        args.metrics_interval),
+                                    warm_start=args.warm_start,
+                                    lazy=args.lazy,
+                                    previous=previous)
+
+        if complete:
+            store = CommitStore(store_path)
+            store.set_meta("processed_tip", head.sha1)
+            store.set_meta("processed_since", since)
+            store.close()
+        else:
+            logging.warning("Not every bug was processed, so %s isn't recorded as the last "
+                            "processed tip" % head.sha1)
+    finally:
+        if profiler is not None:
+            profiler.stop()
+            merge_profiles(profile_dir)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,218 @@
+import json
+import logging
+import os
+import time
+
+from .cache import cache_stats
+from .parsecache import get_cache
+
+# Seconds between metrics snapshots
+default_interval = 30
+
+
+def current_rss():
+    # Resident set size of this process in bytes, or None if it's unknown
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    # Peak rather than current usage; ru_maxrss is in KB on Linux but bytes on macOS
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def hit_rate(hits, misses):
+    return hits / (hits + misses) if hits + misses else None
+
+
+class Histogram:
+    # Counts of values in power of two buckets, which is enough to estimate
+    # tail percentiles without keeping every value
+    def __init__(self, unit=1):
+        # Values are divided by unit before bucketing, so that e.g. seconds
+        # can be recorded in ms buckets
+        self.unit = unit
+        self.buckets = {}
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+        bucket = int(value / self.unit).bit_length()
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+
+    def merge(self, other):
+        for bucket, count in other.buckets.items():
+            self.buckets[bucket] = self.buckets.get(bucket, 0) + count
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def percentile(self, fraction):
+        # Upper bound of the bucket containing the percentile
+        if not self.count:
+            return None
+        target = fraction * self.count
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= target:
+                return min((1 << bucket) * self.unit, self.max)
+        return self.max
+
+    def to_json(self):
+        return {"count": self.count,
+                "mean": self.total / self.count if self.count else None,
+                "p50": self.percentile(0.5),
+                "p90": self.percentile(0.9),
+                "p99": self.percentile(0.99),
+                "max": self.max,
+                "buckets": {str(bucket): count for bucket, count in self.buckets.items()}}
+
+    @classmethod
+    def from_json(cls, data, unit=1):
+        rv = cls(unit)
+        rv.buckets = {int(bucket): count for bucket, count in data["buckets"].items()}
+        rv.count = data["count"]
+        rv.total = data["mean"] * data["count"] if data["count"] else 0
+        rv.max = data["max"]
+        return rv
+
+
+class WorkerMetrics:
+    # Counters for a single get_suites_changes worker
+    def __init__(self, name, interval=default_interval):
+        self.name = name
+        self.interval = interval
+        self.start_time = time.time()
+        self.last_report = self.start_time
+        self.bugs = 0
+        self.diff_sizes = Histogram()
+        self.update_latency = Histogram(unit=0.001)
+
+    def bug_done(self):
+        self.bugs += 1
+
+    def due(self):
+        return time.time() - self.last_report >= self.interval
+
+    def snapshot(self, repo=None):
+        now = time.time()
+        self.last_report = now
+        elapsed = now - self.start_time
+        caches = {name: {"entries": stats["entries"],
+                         "hit_rate": hit_rate(stats["hits"], stats["misses"])}
+                  for name, stats in cache_stats().items()}
+        parse_cache = get_cache()
+        if parse_cache is not None:
+            for name, (hits, misses) in parse_cache.stats.items():
+                caches["parse_cache:%s" % name] = {"hit_rate": hit_rate(hits, misses)}
+        if repo is not None:
+            stats = repo.commit_cache_stats()
+            caches["commits"] = {"entries": stats["size"],
+                                 "hit_rate": hit_rate(stats["hits"], stats["misses"])}
+        return {"name": self.name,
+                "pid": os.getpid(),
+                "elapsed": elapsed,
+                "bugs": self.bugs,
+                "bugs_per_second": self.bugs / elapsed if elapsed else None,
+                "rss": current_rss(),
+                "caches": caches,
+                "diff_sizes": self.diff_sizes.to_json(),
+                "update_latency": self.update_latency.to_json()}
+
+
+class MetricsRecorder:
+    # Collects the latest snapshot from each worker and periodically appends
+    # a combined snapshot to a JSON lines file
+    def __init__(self, path, summary_path, interval=default_interval):
+        self.path = path
+        self.summary_path = summary_path
+        self.interval = interval
+        self.start_time = time.time()
+        self.last_write = self.start_time
+        self.workers = {}
+        self.processed = 0
+        self.queued = 0
+        self._queue_depths = None
+        with open(self.path, "w"):
+            pass
+
+    def set_queue_depths(self, func):
+        # func() returns {queue name: number of items}
+        self._queue_depths = func
+
+    def update_worker(self, snapshot):
+        self.workers[snapshot["name"]] = snapshot
+        self.maybe_write()
+
+    def result(self):
+        self.processed += 1
+        self.maybe_write()
+
+    def snapshot(self):
+        now = time.time()
+        elapsed = now - self.start_time
+        queues = {}
+        if self._queue_depths is not None:
+            queues = self._queue_depths()
+        return {"time": now,
+                "elapsed": elapsed,
+                "queued": self.queued,
+                "processed": self.processed,
+                "bugs_per_second": self.processed / elapsed if elapsed else None,
+                "queues": queues,
+                "main": {"pid": os.getpid(), "rss": current_rss()},
+                "workers": self.workers}
+
+    def maybe_write(self):
+        if time.time() - self.last_write >= self.interval:
+            self.write()
+
+    def write(self):
+        self.last_write = time.time()
+        with open(self.path, "a") as f:
+            json.dump(self.snapshot(), f)
+            f.write("\n")
+
+    def summary(self):
+        snapshot = self.snapshot()
+        update_latency = Histogram(unit=0.001)
+        diff_sizes = Histogram()
+        for worker in self.workers.values():
+            update_latency.merge(Histogram.from_json(worker["update_latency"], unit=0.001))
+            diff_sizes.merge(Histogram.from_json(worker["diff_sizes"]))
+        rss = [worker["rss"] for worker in self.workers.values() if worker["rss"] is not None]
+        return {"elapsed": snapshot["elapsed"],
+                "queued": self.queued,
+                "processed": self.processed,
+                "bugs_per_second": snapshot["bugs_per_second"],
+                "workers": {name: {"bugs": worker["bugs"],
+                                   "bugs_per_second": worker["bugs_per_second"],
+                                   "rss": worker["rss"]}
+                            for name, worker in self.workers.items()},
+                "max_worker_rss": max(rss) if rss else None,
+                "main_rss": snapshot["main"]["rss"],
+                "diff_sizes": diff_sizes.to_json(),
+                "update_latency": update_latency.to_json()}
+
+    def close(self):
+        self.write()
+        summary = self.summary()
+        with open(self.summary_path, "w") as f:
+            json.dump(summary, f, indent=2)
+        latency = summary["update_latency"]
+        logging.info("Processed %i bugs in %.0fs, %.1f bugs/s" % (
+            summary["processed"], summary["elapsed"], summary["bugs_per_second"] or 0))
+        if latency["count"]:
+            logging.info("TestData update latency mean %.1fms p90 %.1fms p99 %.1fms "
+                         "max %.1fms" % tuple(1000 * latency[key]
+                                              for key in ["mean", "p90", "p99", "max"]))
+        return summary
@@ -1,14 +1,16 @@
 import logging
 import re
 
-from .cache import path_cache
+from .cache import oid_cache
+from .parsecache import parse_cache
 
 mochitest_line = re.compile("( *)([^ ]*)")
 
 mochitest_ini_cache = {}
 
 
-@path_cache
+@oid_cache
+@parse_cache("mochitest_ini", 1)
 def read_mochitest_ini(path, obj):
     logging.debug("Reading %s for %s" % (path, obj.id))
 
@@ -86,8 +88,14 @@ def mochitest_paths(commit, mochitest_manifests):
 
 
 class MochitestData:
-    def __init__(self, commit, manifest_paths):
+    # With lazy set, a change to the manifests doesn't read them until the
+    # data has been loaded once; instead the data is marked as pending, and
+    # load_pending() reads the manifests when the data is first needed.
+    def __init__(self, commit, manifest_paths, lazy=False):
         self.manifest_paths = manifest_paths
+        self.lazy = lazy
+        self.loaded = False
+        self.pending = False
         self._test_count = 0
         self._paths = set()
 
@@ -114,22 +122,30 @@ class MochitestData:
                     paths.add(path_prefix + section)
         self._test_count = test_count
         self._paths = paths
+        self.loaded = True
+        self.pending = False
 
     def update(self, new_commit, path_changes, path_cache):
         has_updates = False
-        if not self.manifest_paths.isdisjoint(path_changes):
-            has_updates = True
-            self._update_data(new_commit, path_cache)
+        # path_changes can be much larger than manifest_paths, and
+        # set.isdisjoint iterates over its argument
+        if not path_changes.keys().isdisjoint(self.manifest_paths):
+            if self.lazy and not self.loaded:
+                self.pending = True
+            else:
+                has_updates = True
+                self._update_data(new_commit, path_cache)
 
         return has_updates
 
-    def get_data(self):
-        return self._test_count, self._paths
-
+    def load_pending(self, commit, path_cache):
+        if not self.pending:
+            return False
+        self._update_data(commit, path_cache)
+        return True
 
-class MochitestMatcher:
-    def __init__(self, paths):
-        self.paths = paths
+    def dependency_paths(self):
+        return self.manifest_paths
 
-    def __call__(self, changed_paths):
-        return any(item in self.paths for item in changed_paths)
+    def get_data(self):
+        return self._test_count, self._paths
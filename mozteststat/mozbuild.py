@@ -1,12 +1,10 @@
-import io
 import logging
 import re
 import os
-import tokenize
-from collections import defaultdict
 
-from .cache import path_cache
+from .cache import oid_cache
 from .mochitest import MochitestData
+from .parsecache import parse_cache
 from .reftest import ReftestData
 
 manifest_types = {"REFTEST_MANIFESTS": "reftest",
@@ -16,71 +14,124 @@ manifest_types = {"REFTEST_MANIFESTS": "reftest",
 manifest_re = re.compile(b"|".join(item.encode("ascii") for item in manifest_types.keys()))
 
 
-@path_cache
+@oid_cache
 def read_mozbuild(path, obj):
+    path_prefix = path.rsplit("/", 1)[0] + "/"
+    return {test_type: [os.path.normpath(path_prefix + item) for item in items]
+            for test_type, items in read_mozbuild_entries(path, obj).items()}
+
+
+@parse_cache("mozbuild", 3)
+def read_mozbuild_entries(path, obj):
+    # Manifest paths by test type, relative to the directory containing the
+    # moz.build file
     logging.debug("Reading %s for %s" % (path, obj.id))
 
     data = obj.read_raw()
 
-    path_prefix = path.rsplit("/", 1)[0] + "/"
-
     if not manifest_re.search(data):
         entries = {}
         return entries
 
-    data_buf = io.BytesIO(data)
-
-    entries = defaultdict(list)
-
-    state = None
-
-    for tok_type, tok_value, _, _, _ in tokenize.tokenize(data_buf.readline):
-        if state is None:
-            if tok_type == tokenize.NAME and tok_value in manifest_types:
-                state = (manifest_types[tok_value], "start")
-        else:
-            test_type, substate = state
-            if substate == "start" and tok_type == tokenize.OP:
-                assert tok_value == "+="
-                state = (test_type, "after_op")
-            elif substate == "after_op" and tok_type == tokenize.OP:
-                assert tok_value == "["
-                state = (test_type, "before_entry")
-            elif substate == "before_entry":
-                if tok_type == tokenize.STRING:
-                    manifest_path = os.path.normpath(path_prefix + tok_value[1:-1])
-                    entries[test_type].append(manifest_path)
-                    state = (test_type, "after_entry")
-                elif tok_type == tokenize.OP:
-                    if tok_value == "]":
-                        state = None
-                    else:
-                        assert False
-                else:
-                    assert tok_type == tokenize.NL
-            elif substate == "after_entry":
-                if tok_type == tokenize.OP:
-                    if tok_value == ",":
-                        state = (test_type, "before_entry")
-                    elif tok_value == "]":
-                        state = None
-                    else:
-                        assert False
+    entries, errors = scan_mozbuild(data)
+    for line, message in errors:
+        logging.warning("%s line %i: %s" % (path, line, message))
+    return entries
+
+
+# NAME += [ or NAME = [. A lookbehind to check that NAME isn't part of a
+# longer name makes the search several times slower, so that is checked
+# separately.
+assign_re = re.compile(rb"(%s)[ \t]*(\+?=)[ \t]*(\[)?" %
+                       b"|".join(item.encode("ascii") for item in manifest_types.keys()))
+
+name_chars = frozenset(b"abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789_.")
+
+list_token_re = re.compile(rb"""\s+|#[^\n]*|"([^"\\\n]*)"|'([^'\\\n]*)'|(,)|(\])""")
+
+
+def in_comment_or_string(line):
+    # Whether the end of line, the start of a line up to some position, is
+    # inside a comment or a string literal
+    quote = None
+    escaped = False
+    for char in line:
+        if quote is not None:
+            if escaped:
+                escaped = False
+            elif char == ord("\\"):
+                escaped = True
+            elif char == quote:
+                quote = None
+        elif char == ord("#"):
+            return True
+        elif char in (ord('"'), ord("'")):
+            quote = char
+    return quote is not None
+
+
+def scan_mozbuild(data):
+    # Extract the manifest lists from a moz.build file without tokenizing it.
+    # Assignments are found wherever they are, so lists in conditional blocks
+    # are included. Returns ({test type: [manifest path]}, [(line, error)]);
+    # an assignment that can't be parsed is skipped and reported as an error.
+    entries = {}
+    errors = []
+
+    for match in assign_re.finditer(data):
+        start = match.start()
+        if start > 0 and data[start - 1] in name_chars:
+            continue
+        line_start = data.rfind(b"\n", 0, start) + 1
+        if in_comment_or_string(data[line_start:start]):
+            continue
+
+        name = match.group(1).decode("ascii")
+        if match.group(3) is None:
+            errors.append((data.count(b"\n", 0, start) + 1,
+                           "%s is not assigned a list literal" % name))
+            continue
+
+        items = []
+        pos = match.end()
+        while True:
+            token = list_token_re.match(data, pos)
+            if token is None:
+                if pos < len(data):
+                    context = data[pos:pos + 20].decode("utf8", "replace")
+                    message = "Unexpected %r in %s" % (context, name)
                 else:
-                    assert tok_type == tokenize.NL
+                    message = "Unterminated list for %s" % name
+                errors.append((data.count(b"\n", 0, pos) + 1, message))
+                items = None
+                break
+            pos = token.end()
+            double_quoted, single_quoted, _, close = token.groups()
+            if close is not None:
+                break
+            item = double_quoted if double_quoted is not None else single_quoted
+            if item is not None:
+                items.append(item.decode("utf8"))
 
-    return entries
+        if items is not None:
+            entries.setdefault(manifest_types[name], []).extend(items)
+
+    return entries, errors
 
 
 class MozBuildData:
-    def __init__(self, path):
+    def __init__(self, path, lazy=False):
         self.path = path
+        self.lazy = lazy
         self._by_type = {
             "mochitest": None,
             "reftest": None,
             "crashtest": None
         }
         self.suites = set()
+        # suite -> (added test paths, removed test paths) reported by the
+        # ReftestData updates since take_path_changes was last called
+        self._path_changes = {}
 
     def update(self, commit, obj):
         updated_suites = set()
@@ -96,15 +147,17 @@ class MozBuildData:
             if existing is None or existing.manifest_paths != manifest_paths:
                 updated_suites.add(suite)
                 if suite == "mochitest":
-                    data = MochitestData(commit, manifest_paths)
+                    data = MochitestData(commit, manifest_paths, self.lazy)
                 else:
-                    data = ReftestData(commit, manifest_paths)
+                    data = ReftestData(commit, manifest_paths, self.lazy)
                 self._by_type[suite] = data
+                self._path_changes.pop(suite, None)
         self.suites = new_suites
 
         removed_suites = old_suites - new_suites
         for suite in removed_suites:
             self._by_type[suite] = None
+            self._path_changes.pop(suite, None)
         updated_suites |= removed_suites
 
         return updated_suites
@@ -116,16 +169,80 @@ class MozBuildData:
                 has_updates = data.update(new_commit, path_changes, path_cache)
                 if has_updates:
                     suites_with_updates.add(suite)
+                    if suite != "mochitest":
+                        self._add_path_changes(suite, *has_updates)
         if suites_with_updates:
             logging.debug("Paths changed in suites: %s" % " ".join(suites_with_updates))
         return suites_with_updates
 
+    def _add_path_changes(self, suite, new_paths, lost_paths):
+        pending = self._path_changes.get(suite)
+        if pending is None:
+            self._path_changes[suite] = (new_paths, lost_paths)
+            return
+        pending_new, pending_lost = pending
+        for path in new_paths:
+            if path in pending_lost:
+                pending_lost.remove(path)
+            else:
+                pending_new.add(path)
+        for path in lost_paths:
+            if path in pending_new:
+                pending_new.remove(path)
+            else:
+                pending_lost.add(path)
+
+    def take_path_changes(self, suite):
+        # (added test paths, removed test paths) for a reftest or crashtest
+        # suite since the last call
+        return self._path_changes.pop(suite, ((), ()))
+
+    def dependency_paths(self):
+        # Paths that, when changed, may change the data for this moz.build
+        rv = set()
+        for data in self._by_type.values():
+            if data:
+                rv |= data.dependency_paths()
+        return rv
+
+    def mark_pending(self):
+        # Leave the manifests to be read by load_pending, for a moz.build file
+        # that is only read when it's needed
+        for data in self._by_type.values():
+            if data:
+                data.pending = True
+
+    def pending_dirs(self):
+        # Directories containing manifests that haven't been read yet
+        rv = set()
+        for data in self._by_type.values():
+            if data and data.pending:
+                rv.update(path.rsplit("/", 1)[0] if "/" in path else ""
+                          for path in data.manifest_paths)
+        return frozenset(rv)
+
+    def load_pending(self, commit, path_cache):
+        # Returns the suites whose manifests were read
+        loaded = set()
+        for suite, data in self._by_type.items():
+            if not data:
+                continue
+            changes = data.load_pending(commit, path_cache)
+            if changes:
+                loaded.add(suite)
+                if suite != "mochitest":
+                    self._add_path_changes(suite, *changes)
+        return loaded
+
     def get_manifest_paths(self, suite):
         suite_data = self._by_type[suite]
         if suite_data is None:
             return set()
         return suite_data.manifest_paths
 
+    def suite_data(self, suite):
+        return self._by_type[suite]
+
     def get_data(self, suite):
         suite_data = self._by_type[suite]
         if suite_data is None:
@@ -133,7 +250,7 @@ class MozBuildData:
         return suite_data.get_data()
 
     @classmethod
-    def for_file(cls, commit, path, obj):
-        rv = cls(path)
+    def for_file(cls, commit, path, obj, lazy=False):
+        rv = cls(path, lazy)
         rv.update(commit, obj)
         return rv
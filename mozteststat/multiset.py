@@ -0,0 +1,41 @@
+class PathMultiset:
+    # Set of paths where each path is reference counted, so that several
+    # contributors can add and remove the same path independently
+    def __init__(self):
+        self._counts = {}
+
+    def __contains__(self, path):
+        return path in self._counts
+
+    def __iter__(self):
+        return iter(self._counts)
+
+    def __len__(self):
+        return len(self._counts)
+
+    def update(self, added=(), removed=()):
+        # Returns (paths that are now present but weren't before,
+        #          paths that were present but now aren't)
+        counts = self._counts
+        was_present = {}
+        for path in added:
+            if path not in was_present:
+                was_present[path] = path in counts
+            counts[path] = counts.get(path, 0) + 1
+        for path in removed:
+            if path not in was_present:
+                was_present[path] = path in counts
+            count = counts[path] - 1
+            if count:
+                counts[path] = count
+            else:
+                del counts[path]
+        new_paths = []
+        lost_paths = []
+        for path, present in was_present.items():
+            if path in counts:
+                if not present:
+                    new_paths.append(path)
+            elif present:
+                lost_paths.append(path)
+        return new_paths, lost_paths
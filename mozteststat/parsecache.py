@@ -0,0 +1,120 @@
+import pickle
+import sqlite3
+from collections import defaultdict
+
+_cache = None
+
+
+def get_cache():
+    return _cache
+
+
+def set_cache(cache):
+    global _cache
+    _cache = cache
+
+
+class ParseCache:
+    # Parse results shared between processes and runs, keyed by parser name,
+    # parser version and the blob id of the parsed file. Each process has its
+    # own connection; the database uses WAL mode so readers and writers in
+    # different processes don't block each other, and writes are batched.
+    def __init__(self, path, batch_size=500):
+        self.path = path
+        self.batch_size = batch_size
+        self._conn = sqlite3.connect(path, timeout=60)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        with self._conn:
+            self._conn.execute("CREATE TABLE IF NOT EXISTS results "
+                               "(name TEXT, version INTEGER, oid TEXT, value BLOB, "
+                               "PRIMARY KEY (name, version, oid)) WITHOUT ROWID")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS stats "
+                               "(name TEXT PRIMARY KEY, hits INTEGER, misses INTEGER)")
+        self._pending = {}
+        # name -> [hits, misses] since the last flush, and in total
+        self._unflushed_stats = defaultdict(lambda: [0, 0])
+        self.stats = defaultdict(lambda: [0, 0])
+
+    def get(self, name, version, oid):
+        # Returns (found, value)
+        key = (name, version, oid)
+        data = self._pending.get(key)
+        if data is None:
+            row = self._conn.execute("SELECT value FROM results "
+                                     "WHERE name = ? AND version = ? AND oid = ?",
+                                     key).fetchone()
+            if row is not None:
+                data = row[0]
+        index = 0 if data is not None else 1
+        self.stats[name][index] += 1
+        self._unflushed_stats[name][index] += 1
+        if data is None:
+            return False, None
+        return True, pickle.loads(data)
+
+    def put(self, name, version, oid, value):
+        self._pending[(name, version, oid)] = pickle.dumps(value,
+                                                           protocol=pickle.HIGHEST_PROTOCOL)
+        if len(self._pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        with self._conn:
+            if self._pending:
+                self._conn.executemany("INSERT OR IGNORE INTO results VALUES (?, ?, ?, ?)",
+                                       [key + (value,) for key, value in self._pending.items()])
+                self._pending = {}
+            for name, (hits, misses) in self._unflushed_stats.items():
+                self._conn.execute("INSERT OR IGNORE INTO stats VALUES (?, 0, 0)", (name,))
+                self._conn.execute("UPDATE stats SET hits = hits + ?, misses = misses + ? "
+                                   "WHERE name = ?", (hits, misses, name))
+            self._unflushed_stats.clear()
+
+    def total_stats(self):
+        # Hits and misses recorded by all processes over all runs
+        return {name: (hits, misses) for name, hits, misses in
+                self._conn.execute("SELECT name, hits, misses FROM stats")}
+
+    def close(self):
+        self.flush()
+        self._conn.close()
+
+
+def format_stats(stats):
+    parts = []
+    for name, (hits, misses) in sorted(stats.items()):
+        total = hits + misses
+        parts.append("%s: %i hits %i misses (%.0f%%)" %
+                     (name, hits, misses, 100 * hits / total if total else 0))
+    return ", ".join(parts)
+
+
+def parse_cache(name, version):
+    # Cache the result of func(path, obj) in the current ParseCache, if there
+    # is one. The result must depend only on the contents of obj, and version
+    # must be bumped whenever the parser output changes. ValueError from the
+    # parser is cached and re-raised.
+    def decorator(func):
+        def inner(path, obj):
+            cache = _cache
+            if cache is None:
+                return func(path, obj)
+
+            oid = str(obj.id)
+            found, value = cache.get(name, version, oid)
+            if not found:
+                try:
+                    value = (True, func(path, obj))
+                except ValueError as e:
+                    value = (False, str(e))
+                cache.put(name, version, oid, value)
+            ok, result = value
+            if not ok:
+                raise ValueError(result)
+            return result
+
+        inner.__name__ = func.__name__
+        inner.__doc__ = func.__doc__
+
+        return inner
+    return decorator
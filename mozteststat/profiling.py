@@ -0,0 +1,129 @@
+import cProfile
+import glob
+import io
+import json
+import logging
+import os
+import pstats
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+
+class StageTimes:
+    # Wall clock time spent in each named stage of this process
+    def __init__(self):
+        self.enabled = False
+        self.reset()
+
+    def reset(self):
+        self.totals = defaultdict(float)
+        self.counts = defaultdict(int)
+
+    def add(self, name, elapsed):
+        self.totals[name] += elapsed
+        self.counts[name] += 1
+
+    def to_json(self):
+        return {name: {"total": total, "count": self.counts[name]}
+                for name, total in self.totals.items()}
+
+
+stage_times = StageTimes()
+
+# The running Profiler in this process, if any
+_active = None
+
+
+@contextmanager
+def stage(name):
+    if not stage_times.enabled:
+        yield
+        return
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        stage_times.add(name, time.perf_counter() - t0)
+
+
+class Profiler:
+    # cProfile for one process, written to <profile_dir>/<name>.prof with the
+    # stage times alongside in <name>.stages.json
+    def __init__(self, profile_dir, name):
+        self.profile_dir = profile_dir
+        self.name = name
+        self._profile = cProfile.Profile()
+
+    def start(self):
+        global _active
+        if _active is not None:
+            # Inherited from the parent by a forked worker; the parent writes
+            # its own profile
+            _active._profile.disable()
+        _active = self
+        stage_times.reset()
+        stage_times.enabled = True
+        self._profile.enable()
+
+    def stop(self):
+        global _active
+        self._profile.disable()
+        _active = None
+        stage_times.enabled = False
+        base_path = os.path.join(self.profile_dir, self.name)
+        self._profile.dump_stats(base_path + ".prof")
+        with open(base_path + ".stages.json", "w") as f:
+            json.dump(stage_times.to_json(), f)
+
+
+def clear_profiles(profile_dir):
+    os.makedirs(profile_dir, exist_ok=True)
+    for path in (glob.glob(os.path.join(profile_dir, "*.prof")) +
+                 glob.glob(os.path.join(profile_dir, "*.stages.json"))):
+        os.unlink(path)
+
+
+def merge_stage_times(profile_dir):
+    # {stage: (total over all processes, max in any one process, count)}
+    rv = {}
+    for path in sorted(glob.glob(os.path.join(profile_dir, "*.stages.json"))):
+        with open(path) as f:
+            for name, data in json.load(f).items():
+                total, max_total, count = rv.get(name, (0, 0, 0))
+                rv[name] = (total + data["total"],
+                            max(max_total, data["total"]),
+                            count + data["count"])
+    return rv
+
+
+def merge_profiles(profile_dir, limit=50):
+    # Combine the per-process profiles into merged.prof, and write the stage
+    # times and the top functions by cumulative time to summary.txt
+    paths = sorted(path for path in glob.glob(os.path.join(profile_dir, "*.prof"))
+                   if os.path.basename(path) != "merged.prof")
+    if not paths:
+        return None
+
+    out = io.StringIO()
+    out.write("Merged %i profiles: %s\n\n" % (len(paths),
+                                              " ".join(os.path.basename(path)
+                                                       for path in paths)))
+    out.write("%-20s %10s %10s %8s\n" % ("stage", "total (s)", "max (s)", "count"))
+    stages = merge_stage_times(profile_dir)
+    for name, (total, max_total, count) in sorted(stages.items(),
+                                                  key=lambda item: -item[1][0]):
+        line = "%-20s %10.3f %10.3f %8i" % (name, total, max_total, count)
+        logging.info("Stage %s" % line)
+        out.write(line + "\n")
+    out.write("\n")
+
+    stats = pstats.Stats(*paths, stream=out)
+    stats.dump_stats(os.path.join(profile_dir, "merged.prof"))
+    stats.sort_stats("cumulative").print_stats(limit)
+
+    summary_path = os.path.join(profile_dir, "summary.txt")
+    with open(summary_path, "w") as f:
+        f.write(out.getvalue())
+    logging.info("Wrote profile summary to %s" % summary_path)
+    return summary_path
@@ -1,9 +1,10 @@
 import logging
 import os
 import re
-from collections import deque
+from collections import namedtuple
 
-from .cache import path_cache
+from .cache import oid_cache
+from .parsecache import parse_cache
 
 reftest_re = re.compile("(?:^| )(url-prefix|include|load|==|!=|print) ([^ ]*)(?: ([^ ]*))?")
 
@@ -18,7 +19,8 @@ def parse_reftest_file(prefix, name):
     return name
 
 
-@path_cache
+@oid_cache
+@parse_cache("reftest_list", 1)
 def read_reftest_list(path, obj):
     logging.debug("Reading %s for %s" % (path, obj.id))
 
@@ -63,63 +65,168 @@ def read_reftest_list(path, obj):
             "files": files}
 
 
-class ReftestData:
-    def __init__(self, commit, manifest_paths):
-        self.manifest_paths = manifest_paths
-        self._included_paths = set()
-        self._test_count = 0
-        self._test_paths = set()
+ReftestNode = namedtuple("ReftestNode", ["test_count", "files", "includes"])
 
-    def _update(self, commit, path_cache):
-        queue = deque(self.manifest_paths)
+empty_node = ReftestNode(0, frozenset(), ())
 
-        test_count = 0
-        paths = set()
-        included_paths = set()
 
-        while queue:
-            path = queue.popleft()
-            path_prefix = path.rsplit("/", 1)[0] + "/"
+@oid_cache
+def read_reftest_node(path, obj):
+    # The contribution of a single manifest, with paths made absolute
+    path_prefix = path.rsplit("/", 1)[0] + "/"
+    file_data = read_reftest_list(path, obj)
+    return ReftestNode(len(file_data["tests"]),
+                       frozenset(path_prefix + rel_path for rel_path in file_data["files"]),
+                       tuple(os.path.normpath(path_prefix + item)
+                             for item in file_data["includes"]))
 
-            obj = path_cache.get(path, commit.tree)
 
-            file_data = read_reftest_list(path, obj)
-            for item in file_data["includes"]:
-                include_path = os.path.normpath(path_prefix + item)
-                queue.append(include_path)
-                included_paths.add(include_path)
-
-            test_count += len(file_data["tests"])
-            for rel_path in file_data["files"]:
-                paths.add(path_prefix + rel_path)
-
-        self._included_paths = included_paths
-        self._test_count = test_count
-        self._test_paths = paths
+class ReftestData:
+    # The manifests reachable from manifest_paths through include directives
+    # form a graph. Each manifest's contribution is stored with the number of
+    # references to it from the roots and other reachable manifests, and the
+    # totals are kept as counts, so that when a manifest changes only that
+    # manifest needs to be read again. A manifest that is reachable by more
+    # than one route is only counted once. Include cycles are not expected,
+    # and aren't collected if they become unreachable.
+    #
+    # update returns the test paths whose count went to or from zero, so
+    # that the totals over all the moz.build files can be updated without
+    # comparing whole path sets.
+    #
+    # With lazy set, the manifests are marked as pending rather than read
+    # when they would first be read, as for MochitestData, and
+    # load_pending() reads them.
+    def __init__(self, commit, manifest_paths, lazy=False):
+        self.manifest_paths = manifest_paths
+        self.lazy = lazy
+        self.pending = False
+        self._nodes = {}
+        self._refs = {}
+        self._path_counts = {}
+        self._test_count = 0
+        # Paths added and removed during the current update
+        self._new_paths = None
+        self._lost_paths = None
+
+    def _read_node(self, commit, path, path_changes, path_cache):
+        change = path_changes.get(path)
+        if change is None or change[0] != "D":
+            try:
+                obj = path_cache.get(path, commit.tree)
+            except KeyError:
+                pass
+            else:
+                return read_reftest_node(path, obj)
+        logging.warning("Reftest manifest %s doesn't exist in %s" % (path, commit.sha1))
+        return empty_node
+
+    def _add_node(self, path, node):
+        self._nodes[path] = node
+        self._test_count += node.test_count
+        path_counts = self._path_counts
+        for file_path in node.files:
+            count = path_counts.get(file_path, 0)
+            path_counts[file_path] = count + 1
+            if not count:
+                if file_path in self._lost_paths:
+                    self._lost_paths.remove(file_path)
+                else:
+                    self._new_paths.add(file_path)
+
+    def _remove_node(self, path):
+        node = self._nodes.pop(path)
+        self._test_count -= node.test_count
+        path_counts = self._path_counts
+        for file_path in node.files:
+            count = path_counts[file_path] - 1
+            if count:
+                path_counts[file_path] = count
+            else:
+                del path_counts[file_path]
+                if file_path in self._new_paths:
+                    self._new_paths.remove(file_path)
+                else:
+                    self._lost_paths.add(file_path)
+        return node
+
+    def _add_ref(self, commit, path, path_changes, path_cache):
+        stack = [path]
+        while stack:
+            path = stack.pop()
+            refs = self._refs.get(path, 0)
+            self._refs[path] = refs + 1
+            if refs == 0:
+                node = self._read_node(commit, path, path_changes, path_cache)
+                self._add_node(path, node)
+                stack.extend(node.includes)
+
+    def _remove_ref(self, path):
+        stack = [path]
+        while stack:
+            path = stack.pop()
+            refs = self._refs[path] - 1
+            if refs:
+                self._refs[path] = refs
+            else:
+                del self._refs[path]
+                stack.extend(self._remove_node(path).includes)
 
     def update(self, new_commit, path_changes, path_cache):
-        has_updates = False
-        if any(path in self.manifest_paths or path in self._included_paths
-               for path in path_changes.keys()):
-            has_updates = True
-            self._update(new_commit, path_cache)
-
-        return has_updates
+        # Returns None if nothing changed, otherwise
+        # (test paths that were added, test paths that were removed)
+        if not self._nodes:
+            # Nothing has been read yet; wait for a change to a root manifest
+            if path_changes.keys().isdisjoint(self.manifest_paths):
+                return None
+            if self.lazy:
+                self.pending = True
+                return None
+            self._new_paths, self._lost_paths = set(), set()
+            for path in self.manifest_paths:
+                self._add_ref(new_commit, path, path_changes, path_cache)
+        else:
+            if len(path_changes) < len(self._nodes):
+                changed = [path for path in path_changes if path in self._nodes]
+            else:
+                changed = [path for path in self._nodes if path in path_changes]
+            if not changed:
+                return None
+            self._new_paths, self._lost_paths = set(), set()
+            for path in changed:
+                if path not in self._nodes:
+                    # No longer reachable after an earlier change
+                    continue
+                old_node = self._remove_node(path)
+                node = self._read_node(new_commit, path, path_changes, path_cache)
+                self._add_node(path, node)
+                if node.includes != old_node.includes:
+                    # Add the new references first so that shared manifests
+                    # aren't dropped and read again
+                    for include_path in node.includes:
+                        self._add_ref(new_commit, include_path, path_changes, path_cache)
+                    for include_path in old_node.includes:
+                        self._remove_ref(include_path)
+
+        rv = self._new_paths, self._lost_paths
+        self._new_paths = self._lost_paths = None
+        return rv
+
+    def load_pending(self, commit, path_cache):
+        # Returns None if nothing was pending, otherwise the test paths that
+        # were added and removed, as for update
+        if not self.pending:
+            return None
+        self.pending = False
+        self._new_paths, self._lost_paths = set(), set()
+        for path in self.manifest_paths:
+            self._add_ref(commit, path, {}, path_cache)
+        rv = self._new_paths, self._lost_paths
+        self._new_paths = self._lost_paths = None
+        return rv
+
+    def dependency_paths(self):
+        return self.manifest_paths | self._nodes.keys()
 
     def get_data(self):
-        return self._test_count, self._test_paths
-
-
-class ReftestMatcher:
-    def __init__(self, paths, manifest_paths):
-        parts = []
-        self.manifest_paths = manifest_paths
-        for path in sorted(paths):
-            dir_name = path.rsplit("/", 1)[0]
-            if not (parts and dir_name.startswith(parts[-1])):
-                parts.append(dir_name)
-        self.regex = re.compile("|".join(parts))
-
-    def __call__(self, changed_paths):
-        return any(path not in self.manifest_paths and self.regex.match(path)
-                   for path in changed_paths)
+        return self._test_count, self._path_counts.keys()
@@ -0,0 +1,39 @@
+import time
+
+
+class ResultBatcher:
+    # Collects result rows in a worker and sends them to the main process as
+    # a list, once max_size rows are waiting or max_delay seconds after the
+    # oldest unsent row, so that progress is still reported regularly. The
+    # delay is only checked when put or maybe_flush is called, so the worker
+    # calls maybe_flush before anything that might take a while.
+    def __init__(self, send, max_size=256, max_delay=1.0):
+        self._send = send
+        self.max_size = max_size
+        self.max_delay = max_delay
+        self._rows = []
+        self._first_time = None
+
+    def put(self, row):
+        if not self._rows:
+            self._first_time = time.time()
+        self._rows.append(row)
+        if len(self._rows) >= self.max_size:
+            self.flush()
+        else:
+            self.maybe_flush()
+
+    def maybe_flush(self):
+        # Send the pending rows if the oldest has waited max_delay seconds
+        if self._rows and time.time() - self._first_time >= self.max_delay:
+            self.flush()
+
+    def flush(self):
+        if self._rows:
+            self._send(self._rows)
+            self._rows = []
+
+    def send(self, message):
+        # Send a message that isn't a result, after any pending rows
+        self.flush()
+        self._send(message)
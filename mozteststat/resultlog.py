@@ -0,0 +1,73 @@
+import json
+import logging
+import os
+import time
+
+
+class ResultLog:
+    # Append-only log of per-bug results, one JSON record per line.
+    #
+    # Records are flushed and fsynced in batches, so a crash loses at most the
+    # last batch. A record is only valid once its trailing newline is written;
+    # reading stops at the first incomplete or corrupt record, and opening the
+    # log for writing truncates the file back to the end of the last valid
+    # record.
+    def __init__(self, path, sync_count=100, sync_interval=5):
+        self.path = path
+        self.sync_count = sync_count
+        self.sync_interval = sync_interval
+        self.valid_size = None
+        self._f = None
+        self._pending = 0
+        self._last_sync = None
+
+    def records(self):
+        size = 0
+        if os.path.exists(self.path):
+            with open(self.path, "rb") as f:
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        break
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        break
+                    size += len(line)
+                    yield record
+        self.valid_size = size
+
+    def open(self, truncate=False):
+        if truncate:
+            self.valid_size = 0
+        elif self.valid_size is None:
+            for _ in self.records():
+                pass
+        if os.path.exists(self.path):
+            if os.path.getsize(self.path) != self.valid_size:
+                logging.warning("Truncating %s from %i to %i bytes" %
+                                (self.path, os.path.getsize(self.path), self.valid_size))
+            self._f = open(self.path, "r+b")
+            self._f.truncate(self.valid_size)
+            self._f.seek(self.valid_size)
+        else:
+            self._f = open(self.path, "wb")
+        self._last_sync = time.time()
+
+    def append(self, record):
+        self._f.write(json.dumps(record).encode("utf8") + b"\n")
+        self._pending += 1
+        if (self._pending >= self.sync_count or
+            time.time() - self._last_sync >= self.sync_interval):
+            self.sync()
+
+    def sync(self):
+        self._f.flush()
+        os.fsync(self._f.fileno())
+        self._pending = 0
+        self._last_sync = time.time()
+
+    def close(self):
+        if self._f is not None:
+            self.sync()
+            self._f.close()
+            self._f = None
@@ -0,0 +1,94 @@
+import multiprocessing
+
+# Largest number of items a worker claims at once
+max_batch_size = 32
+
+
+class Scheduler:
+    # Hands out items, which are expected to be in history order, so that each
+    # worker processes a contiguous run of history. A worker that runs out of
+    # items takes the second half of the largest remaining run, so it also
+    # continues through a contiguous range.
+    def __init__(self, items, num_workers):
+        self.items = items
+        self.num_workers = num_workers
+        self._lock = multiprocessing.Lock()
+        # [start, end) of the remaining run for each worker
+        self._bounds = multiprocessing.RawArray("q", 2 * num_workers)
+        for worker_id in range(num_workers):
+            self._bounds[2 * worker_id] = (worker_id * len(items)) // num_workers
+            self._bounds[2 * worker_id + 1] = ((worker_id + 1) * len(items)) // num_workers
+
+    def queue(self, worker_id):
+        return SchedulerQueue(self, worker_id)
+
+    def _steal(self, worker_id):
+        bounds = self._bounds
+        victim = None
+        victim_size = 0
+        for other_id in range(self.num_workers):
+            size = bounds[2 * other_id + 1] - bounds[2 * other_id]
+            if other_id != worker_id and size > victim_size:
+                victim = other_id
+                victim_size = size
+        if victim is None:
+            return False
+        end = bounds[2 * victim + 1]
+        mid = end - victim_size // 2 if victim_size > 1 else end - 1
+        bounds[2 * victim + 1] = mid
+        bounds[2 * worker_id] = mid
+        bounds[2 * worker_id + 1] = end
+        return True
+
+    def remaining(self):
+        # Number of items left in each worker's run
+        with self._lock:
+            bounds = self._bounds
+            return [bounds[2 * worker_id + 1] - bounds[2 * worker_id]
+                    for worker_id in range(self.num_workers)]
+
+    def next_batch(self, worker_id):
+        # Returns (start, end, stolen) for the next items to process, or
+        # (None, None, False) when there is no work left. A batch is a quarter
+        # of the worker's remaining run, up to max_batch_size, so the lock is
+        # taken less often while most of the run can still be stolen, and
+        # batches shrink to single items as the run is used up.
+        with self._lock:
+            bounds = self._bounds
+            stolen = False
+            if bounds[2 * worker_id] >= bounds[2 * worker_id + 1]:
+                stolen = self._steal(worker_id)
+                if not stolen:
+                    return None, None, False
+            start = bounds[2 * worker_id]
+            remaining = bounds[2 * worker_id + 1] - start
+            end = start + max(1, min(max_batch_size, remaining // 4))
+            bounds[2 * worker_id] = end
+        return start, end, stolen
+
+
+class SchedulerQueue:
+    # Per-worker view of a Scheduler with the same get() interface as a queue
+    # that has been terminated with None
+    def __init__(self, scheduler, worker_id):
+        self.scheduler = scheduler
+        self.worker_id = worker_id
+        self.count = 0
+        self.steals = 0
+        self.batches = 0
+        self._next = 0
+        self._end = 0
+
+    def get(self):
+        if self._next >= self._end:
+            start, end, stolen = self.scheduler.next_batch(self.worker_id)
+            if start is None:
+                return None
+            self._next, self._end = start, end
+            self.batches += 1
+            if stolen:
+                self.steals += 1
+        index = self._next
+        self._next += 1
+        self.count += 1
+        return self.scheduler.items[index]
@@ -0,0 +1,95 @@
+import logging
+import os
+import pickle
+
+from .testdata import TestData
+
+# Bump this whenever the pickled TestData state changes shape
+snapshot_version = 5
+
+
+class SnapshotStore:
+    # Directory of pickled TestData states, one file per commit, named
+    # <commit time>-<sha1>.snapshot so the nearest one can be found by time
+    # without opening any files.
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def entries(self):
+        rv = []
+        for name in os.listdir(self.path):
+            if not name.endswith(".snapshot"):
+                continue
+            commit_time, sha1 = name[:-len(".snapshot")].split("-", 1)
+            rv.append((int(commit_time), sha1, os.path.join(self.path, name)))
+        return rv
+
+    def has(self, sha1):
+        return any(entry_sha1 == sha1 for _, entry_sha1, _ in self.entries())
+
+    def save(self, test_data):
+        commit = test_data.commit
+        path = os.path.join(self.path, "%i-%s.snapshot" % (commit.commit.commit_time, commit.sha1))
+        tmp_path = "%s.%i.tmp" % (path, os.getpid())
+        with open(tmp_path, "wb") as f:
+            pickle.dump({"version": snapshot_version,
+                         "sha1": commit.sha1,
+                         "state": test_data.get_state()},
+                        f,
+                        protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+        logging.info("Wrote TestData snapshot for %s" % commit.sha1)
+
+    def load(self, repo, path, lazy=False):
+        try:
+            with open(path, "rb") as f:
+                data = pickle.load(f)
+        except Exception:
+            logging.warning("Failed to read snapshot %s" % path)
+            return None
+        if data.get("version") != snapshot_version:
+            logging.info("Ignoring snapshot %s with version %s" % (path, data.get("version")))
+            return None
+        return TestData.from_state(repo.lookup(data["sha1"]), data["state"], lazy)
+
+    def load_nearest(self, repo, commit, lazy=False):
+        commit_time = commit.commit.commit_time
+        for _, _, path in sorted(self.entries(),
+                                 key=lambda entry: abs(entry[0] - commit_time)):
+            test_data = self.load(repo, path, lazy)
+            if test_data is not None:
+                logging.info("Starting from snapshot at %s" % test_data.commit.sha1)
+                return test_data
+        return None
+
+
+def first_parent_chain(head, min_time):
+    chain = []
+    commit = head
+    while commit.commit.commit_time >= min_time:
+        chain.append(commit.sha1)
+        if not commit.commit.parent_ids:
+            break
+        commit = commit.repo.get(commit.commit.parent_ids[0])
+    chain.reverse()
+    return chain
+
+
+def write_snapshots(repo, store, head, min_time, interval):
+    # Write snapshots at every interval'th commit along the first-parent
+    # chain, counting from the oldest commit so that the positions stay the
+    # same as the head moves forward.
+    test_data = None
+    chain = first_parent_chain(head, min_time)
+    for sha1 in chain[::interval]:
+        if store.has(sha1):
+            continue
+        commit = repo.lookup(sha1)
+        if test_data is None:
+            test_data = store.load_nearest(repo, commit)
+        if test_data is None:
+            test_data = TestData(commit)
+        else:
+            test_data.update(commit)
+        store.save(test_data)
@@ -1,10 +1,14 @@
 import logging
+import os
+from collections import defaultdict
+
+import pygit2
 
-from .gitutils import iter_tree, paths_changed
-from .mochitest import MochitestMatcher
+from .classifier import PathClassifier
+from .gitutils import get_subtree, iter_tree, paths_changed
 from .mozbuild import MozBuildData
-from .reftest import ReftestMatcher
-from .wpt import has_wpt_changes, has_wpt_meta_changes
+from .multiset import PathMultiset
+from .wpt import wpt_dir_rules
 
 
 class PathCache:
@@ -19,7 +23,8 @@ class PathCache:
         self._data[path] = obj
 
     def remove(self, path):
-        del self._data[path]
+        # The path may not have been read yet
+        self._data.pop(path, None)
 
     def get(self, path, tree):
         rv = self._data.get(path)
@@ -27,10 +32,28 @@ class PathCache:
             return tree[path]
         return rv
 
+    def items(self):
+        return self._data.items()
+
 
 class TestData:
-    def __init__(self, commit):
+    # With lazy set, nothing is read up front. The moz.build files in a
+    # top-level directory are all read when a path in that directory is
+    # first classified, and the manifests they list are read when a path
+    # below the directory containing them is classified. After that they are
+    # kept up to date as usual. Until then the whole directory is relevant.
+    #
+    # Mochitest paths are always below the manifest's directory, so those
+    # classify the same as when everything is read up front. Entries that
+    # point into another top-level directory, such as moz.build manifest
+    # paths starting with "..", or reftest includes and test files, are only
+    # seen once the directory containing them has been read. A moz.build
+    # file or manifest that is first read after it changed is read as it is
+    # then, rather than waiting for the next change to its manifests. The
+    # suite counts only include what has been read.
+    def __init__(self, commit=None, lazy=False):
         self.commit = None
+        self.lazy = lazy
         self._data = {}
         self._tests_by_type = {}
 
@@ -39,23 +62,92 @@ class TestData:
 
         self._path_cache = PathCache(self.cache_names)
 
+        # Reverse index from manifest and included paths to the moz.build
+        # paths of the entries in self._data that depend on them
+        self._dependents = defaultdict(set)
+        self._dependencies = {}
+
+        # Directory -> moz.build paths with unread manifests in that directory
+        self._pending_by_dir = defaultdict(set)
+        self._pending_dirs = {}
+
         self._count_by_suite = {"reftest": 0,
                                 "mochitest": 0,
                                 "crashtest": 0}
 
-        self._paths_by_suite = {"reftest": set(),
-                                "mochitest": set(),
-                                "crashtest": set()}
-
-        self.matcher_by_suite = {
-            "web-platform-tests": has_wpt_changes,
-            "web-platform-tests-meta": has_wpt_meta_changes,
-            "mochitest": None,
-            "reftest": None,
-            "crashtest": None,
-        }
+        self._paths_by_suite = {suite: PathMultiset() for suite in self._count_by_suite}
+        self._manifest_paths_by_suite = {suite: PathMultiset()
+                                         for suite in self._count_by_suite}
+
+        # (test count, test paths, manifest paths) last added to the suite
+        # totals for each (moz.build path, suite)
+        self._contributions = {}
+
+        # Directories containing reftest and crashtest files
+        self._test_dirs_by_suite = {"reftest": PathMultiset(),
+                                    "crashtest": PathMultiset()}
+
+        self.classifier = PathClassifier(list(self._count_by_suite) + list(wpt_dir_rules))
+        for suite, rules in wpt_dir_rules.items():
+            for path, include in rules:
+                self.classifier.add_dir(suite, path, include)
+        # Subtrees in which a changed path can affect classification; the
+        # classifier keeps it in step with its rules, and directories with
+        # unread manifests are added below
+        self.relevance = self.classifier.relevance
+
+        # Top-level directories whose moz.build files have been read, with ""
+        # for the root moz.build file, or None when all of them have been.
+        # The ones that haven't been read are added to the relevance index.
+        self._loaded_dirs = set() if lazy else None
+        self._unloaded_dirs = set()
+
+        if commit is not None:
+            self.update(commit)
+
+    def get_state(self):
+        # Everything needed to recreate this TestData, as picklable objects
+        return {"data": self._data,
+                "loaded_dirs": self._loaded_dirs,
+                "path_cache": {path: str(obj.id) for path, obj in self._path_cache.items()}}
+
+    @classmethod
+    def from_state(cls, commit, state, lazy=False):
+        # lazy applies to the moz.build files and manifests that aren't
+        # already read in state
+        rv = cls(lazy=lazy)
+        rv._data = state["data"]
+        repo = commit.repo.repo
+        for path, oid in state["path_cache"].items():
+            rv._path_cache.set(path, repo[oid])
+        for path in rv._data:
+            rv._update_dependencies(path)
+            rv._update_contributions(path)
+            rv._update_pending(path)
+        rv.commit = commit
+        loaded_dirs = state["loaded_dirs"]
+        if loaded_dirs is None:
+            rv._loaded_dirs = None
+        else:
+            rv._loaded_dirs = set(loaded_dirs)
+            rv._mark_unloaded_dirs(commit.tree)
+            if not lazy:
+                # Read the rest now
+                for top_dir in list(rv._unloaded_dirs) + [""]:
+                    if top_dir not in rv._loaded_dirs:
+                        rv._load_dir(top_dir)
+                for path in list(rv._pending_dirs):
+                    rv._load_mozbuild_pending(path)
+                rv._loaded_dirs = None
+        return rv
 
-        self.update(commit)
+    def rebind(self, repo):
+        # Replace the commit and cached blobs with ones from repo, so that a
+        # TestData inherited by a forked worker doesn't use the parent's
+        # pygit2 Repository
+        self.commit = repo.lookup(self.commit.sha1)
+        for path, obj in list(self._path_cache.items()):
+            self._path_cache.set(path, repo.repo[obj.id])
 
     def update_mozbuild(self, new_commit, path, status, obj):
         if status == "D":
@@ -64,25 +156,59 @@ class TestData:
             return old.suites
 
         if status == "A":
-            self._data[path] = MozBuildData.for_file(new_commit, path, obj)
+            self._data[path] = MozBuildData.for_file(new_commit, path, obj, self.lazy)
             return self._data[path].suites
 
         if status == "M":
             return self._data[path].update(new_commit, obj)
 
+    def _update_dependencies(self, mozbuild_path):
+        mozbuild_data = self._data.get(mozbuild_path)
+        old = self._dependencies.get(mozbuild_path, frozenset())
+        new = (frozenset(mozbuild_data.dependency_paths()) if mozbuild_data is not None
+               else frozenset())
+        if old == new:
+            return
+        for path in old - new:
+            dependents = self._dependents[path]
+            dependents.discard(mozbuild_path)
+            if not dependents:
+                del self._dependents[path]
+        for path in new - old:
+            self._dependents[path].add(mozbuild_path)
+        if new:
+            self._dependencies[mozbuild_path] = new
+        else:
+            self._dependencies.pop(mozbuild_path, None)
+
     def update(self, new_commit):
         prev_commit = self.commit
+        loaded_dirs = self._loaded_dirs
         if prev_commit is None:
-            path_changes = {path: ("A", obj) for path, obj in iter_tree(new_commit.tree)}
+            if loaded_dirs is not None:
+                # Everything is read on demand
+                path_changes = {}
+                self._mark_unloaded_dirs(new_commit.tree)
+            else:
+                path_changes = {path: ("A", obj) for path, obj in iter_tree(new_commit.tree)}
         else:
             path_changes = paths_changed(new_commit, prev_commit)
 
         suites_with_updates = set()
+        changed_mozbuilds = []
 
         for path, (status, obj) in path_changes.items():
+            if loaded_dirs is not None:
+                top_dir = path.split("/", 1)[0] if "/" in path else ""
+                if top_dir not in loaded_dirs:
+                    # Read as it is when it's needed
+                    if top_dir and top_dir not in self._unloaded_dirs:
+                        self._mark_unloaded(top_dir)
+                    continue
             name = path.rsplit("/", 1)[-1]
             if name == "moz.build":
                 suites_with_updates |= self.update_mozbuild(new_commit, path, status, obj)
+                changed_mozbuilds.append(path)
             if name in self.cache_names:
                 if status == "D":
                     self._path_cache.remove(path)
@@ -92,31 +218,191 @@ class TestData:
         if suites_with_updates:
             logging.debug("mozbuild changes updated %s" % suites_with_updates)
 
-        for mozbuild_data in self._data.values():
-            suites_with_updates |= mozbuild_data.update_suites(new_commit,
-                                                               path_changes,
-                                                               self._path_cache)
-
-        for suite in suites_with_updates:
-            count = 0
-            paths = set()
-            manifest_paths = set()
-            for mozbuild_data in self._data.values():
-                mozbuild_count, mozbuild_paths = mozbuild_data.get_data(suite)
-                count += mozbuild_count
-                paths |= mozbuild_paths
-                if suite != "mochitest":
-                    manifest_paths |= mozbuild_data.get_manifest_paths(suite)
-            self._count_by_suite[suite] = count
-            self._paths_by_suite[suite] = paths
+        for path in changed_mozbuilds:
+            self._update_dependencies(path)
 
-            if suite == "mochitest":
-                self.matcher_by_suite[suite] = MochitestMatcher(paths)
-            else:
-                self.matcher_by_suite[suite] = ReftestMatcher(paths, manifest_paths)
+        affected = set()
+        dependents = self._dependents
+        for path in path_changes:
+            if path in dependents:
+                affected |= dependents[path]
+
+        for path in affected:
+            suites_with_updates |= self._data[path].update_suites(new_commit,
+                                                                  path_changes,
+                                                                  self._path_cache)
+            self._update_dependencies(path)
+
+        if suites_with_updates:
+            for path in affected.union(changed_mozbuilds):
+                self._update_contributions(path)
+
+        for path in affected.union(changed_mozbuilds):
+            self._update_pending(path)
 
         self.commit = new_commit
 
+        return len(path_changes)
+
+    def _update_contributions(self, mozbuild_path):
+        # For mochitest the contribution holds the set of test paths. For
+        # reftest and crashtest it holds the ReftestData, and while that stays
+        # the same only the paths that it reports as changed are applied.
+        mozbuild_data = self._data.get(mozbuild_path)
+        for suite in self._count_by_suite:
+            key = (mozbuild_path, suite)
+            old_count, old_paths, old_manifest_paths = self._contributions.get(
+                key, (0, None, frozenset()))
+            if mozbuild_data is None:
+                count, paths, manifest_paths = 0, None, frozenset()
+            elif suite == "mochitest":
+                count, paths = mozbuild_data.get_data(suite)
+                manifest_paths = frozenset()
+            else:
+                paths = mozbuild_data.suite_data(suite)
+                count = paths.get_data()[0] if paths is not None else 0
+                manifest_paths = mozbuild_data.get_manifest_paths(suite)
+
+            self._count_by_suite[suite] += count - old_count
+
+            if suite == "mochitest":
+                if paths is not old_paths:
+                    paths = paths if paths is not None else frozenset()
+                    old_set = old_paths if old_paths is not None else frozenset()
+                    new_paths, lost_paths = self._paths_by_suite[suite].update(
+                        paths - old_set, old_set - paths)
+                    for path in new_paths:
+                        self.classifier.add_path(suite, path)
+                    for path in lost_paths:
+                        self.classifier.remove_path(suite, path)
+            else:
+                if paths is old_paths:
+                    added, removed = (mozbuild_data.take_path_changes(suite)
+                                      if paths is not None else ((), ()))
+                else:
+                    # A different ReftestData, so replace all of the old paths
+                    if mozbuild_data is not None:
+                        mozbuild_data.take_path_changes(suite)
+                    added = paths.get_data()[1] if paths is not None else ()
+                    removed = old_paths.get_data()[1] if old_paths is not None else ()
+                new_paths, lost_paths = self._paths_by_suite[suite].update(added, removed)
+                if new_paths or lost_paths:
+                    self._update_test_dirs(suite, new_paths, lost_paths)
+
+            if manifest_paths is not old_manifest_paths:
+                new_paths, lost_paths = self._manifest_paths_by_suite[suite].update(
+                    manifest_paths - old_manifest_paths,
+                    old_manifest_paths - manifest_paths)
+                # Changes to the manifests themselves don't count as test changes
+                for path in new_paths:
+                    self.classifier.add_path(suite, path, include=False)
+                for path in lost_paths:
+                    self.classifier.remove_path(suite, path)
+
+            if count or paths or manifest_paths:
+                self._contributions[key] = (count, paths, manifest_paths)
+            else:
+                self._contributions.pop(key, None)
+
+    def _update_test_dirs(self, suite, new_paths, lost_paths):
+        new_dirs, lost_dirs = self._test_dirs_by_suite[suite].update(
+            [os.path.normpath(path.rsplit("/", 1)[0]) for path in new_paths],
+            [os.path.normpath(path.rsplit("/", 1)[0]) for path in lost_paths])
+        for path in new_dirs:
+            self.classifier.add_dir(suite, path)
+        for path in lost_dirs:
+            self.classifier.remove_dir(suite, path)
+
+    def _update_pending(self, mozbuild_path):
+        mozbuild_data = self._data.get(mozbuild_path)
+        old = self._pending_dirs.get(mozbuild_path, frozenset())
+        new = mozbuild_data.pending_dirs() if mozbuild_data is not None else frozenset()
+        if old == new:
+            return
+        for path in old - new:
+            pending = self._pending_by_dir[path]
+            pending.discard(mozbuild_path)
+            if not pending:
+                del self._pending_by_dir[path]
+                self.relevance.remove(path, subtree=True)
+        for path in new - old:
+            if path not in self._pending_by_dir:
+                self.relevance.add(path, subtree=True)
+            self._pending_by_dir[path].add(mozbuild_path)
+        if new:
+            self._pending_dirs[mozbuild_path] = new
+        else:
+            self._pending_dirs.pop(mozbuild_path, None)
+
+    def _mark_unloaded(self, top_dir):
+        self.relevance.add(top_dir, subtree=True)
+        self._unloaded_dirs.add(top_dir)
+
+    def _mark_unloaded_dirs(self, tree):
+        for item in tree:
+            if isinstance(item, pygit2.Tree) and item.name not in self._loaded_dirs:
+                if item.name not in self._unloaded_dirs:
+                    self._mark_unloaded(item.name)
+
+    def _load_dirs(self, paths):
+        # Read the moz.build files in the top-level directories of paths
+        loaded_dirs = self._loaded_dirs
+        for path in paths:
+            top_dir = path.split("/", 1)[0] if "/" in path else ""
+            if top_dir not in loaded_dirs:
+                self._load_dir(top_dir)
+
+    def _load_dir(self, top_dir):
+        self._loaded_dirs.add(top_dir)
+        if top_dir in self._unloaded_dirs:
+            self._unloaded_dirs.remove(top_dir)
+            self.relevance.remove(top_dir, subtree=True)
+        # Fill the path cache on the way, as when the whole tree is read
+        tree = self.commit.tree
+        names = self.mozbuild_names | self.cache_names
+        if top_dir:
+            tree = get_subtree(tree, top_dir)
+            if tree is None:
+                return
+            items = [(top_dir + "/" + path, obj) for path, obj in iter_tree(tree, names)]
+        else:
+            items = [(item.name, item) for item in tree
+                     if item.name in names and not isinstance(item, pygit2.Tree)]
+        mozbuilds = []
+        for path, obj in items:
+            if obj.name in self.mozbuild_names:
+                mozbuilds.append((path, obj))
+            else:
+                self._path_cache.set(path, obj)
+        for mozbuild_path, obj in mozbuilds:
+            mozbuild_data = MozBuildData.for_file(self.commit, mozbuild_path, obj, self.lazy)
+            mozbuild_data.mark_pending()
+            self._data[mozbuild_path] = mozbuild_data
+            self._update_dependencies(mozbuild_path)
+            self._update_contributions(mozbuild_path)
+            self._update_pending(mozbuild_path)
+
+    def _load_mozbuild_pending(self, mozbuild_path):
+        if self._data[mozbuild_path].load_pending(self.commit, self._path_cache):
+            self._update_contributions(mozbuild_path)
+        self._update_pending(mozbuild_path)
+
+    def _load_pending(self, paths):
+        # Read the manifests in any ancestor directory of paths
+        pending_by_dir = self._pending_by_dir
+        to_load = set(pending_by_dir.get("", ()))
+        seen_dirs = set()
+        for path in paths:
+            while "/" in path:
+                path = path.rsplit("/", 1)[0]
+                if path in seen_dirs:
+                    break
+                seen_dirs.add(path)
+                if path in pending_by_dir:
+                    to_load |= pending_by_dir[path]
+        for mozbuild_path in to_load:
+            self._load_mozbuild_pending(mozbuild_path)
+
     def changes(self, diff_paths, exclude=None):
         changes = {"A": set(),
                    "M": set()}
@@ -124,11 +410,12 @@ class TestData:
         for status, paths in diff_paths.items():
             if not paths or status == "D":
                 continue
-            for suite, matcher in self.matcher_by_suite.items():
-                if exclude is not None and status in exclude and suite in exclude[status]:
-                    continue
-                if matcher is not None and matcher(paths):
-                    changes[status].add(suite)
+            if self._loaded_dirs is not None:
+                self._load_dirs(paths)
+            if self._pending_by_dir:
+                self._load_pending(paths)
+            skip = exclude.get(status) if exclude is not None else None
+            changes[status] |= self.classifier.classify(paths, skip)
 
         return changes
 
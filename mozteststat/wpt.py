@@ -1,3 +1,15 @@
+# Directory rules for the wpt suites, as (directory, include) pairs. Paths
+# below an excluded directory aren't counted even if an ancestor is included.
+wpt_dir_rules = {
+    "web-platform-tests": [("testing/web-platform/tests", True),
+                           ("testing/web-platform/tests/tools", False),
+                           ("testing/web-platform/tests/resources", False),
+                           ("testing/web-platform/mozilla/tests", True)],
+    "web-platform-tests-meta": [("testing/web-platform/meta", True),
+                                ("testing/web-platform/mozilla/meta", True)],
+}
+
+
 def has_wpt_changes(paths):
     for path in paths:
         if ((path.startswith("testing/web-platform/tests/") and not